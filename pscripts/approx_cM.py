@@ -1,57 +1,195 @@
 #!/usr/bin/env python
-
+"""
+Approximates genetic positions (cM) of physical positions from the Ogut 2015 maize genetic map.
+A map is read once into sorted arrays per chromosome (GeneticMap) and kept in a binary cache
+next to the map file (<map>.npz), so later runs start without parsing the text map. Positions
+are converted in bulk by linear interpolation between the closest map markers.
+"""
 
 import argparse
-import pandas as pd
+import os
+import sys
 import numpy as np
-from scipy import stats
+import pandas as pd
+
+OGUT_PATH='/group/jrigrp/Share/annotations/genetic_map/ogut2015/ogut_fifthcM_map_agp{0}.txt'
+CACHE_VERSION=1
+
 
 def arg_parse():
-    parser=argparse.ArgumentParser(description="""Program description: Uses the Ogut 2015 maize genetic map to approximate the genetic distance between two physical positions""")
-    parser.add_argument("chrom",type=int,help="""Chromosome number""")
-    parser.add_argument("start",type=float,help="""Start position (bp)""")
-    parser.add_argument("end",type=float,help="""End position (bp)""")
+    parser=argparse.ArgumentParser(description="""Program description: Uses the Ogut 2015 maize genetic map to approximate the genetic distance between two physical positions, or the genetic positions of every position in a file""")
+    parser.add_argument("chrom",type=int,nargs='?',help="""Chromosome number""")
+    parser.add_argument("start",type=float,nargs='?',help="""Start position (bp)""")
+    parser.add_argument("end",type=float,nargs='?',help="""End position (bp)""")
     parser.add_argument("--ref",type=str,default="v4",help="""Reference version of physical positions (either v2, v3, or v4) """)
+    parser.add_argument("--map",type=str,default=None,help="""Genetic map file, either the Ogut text map or a csv with columns chr, pos and cM such as data_files/ogut_map.csv (Default: the Ogut map for --ref)""")
+    parser.add_argument("--positions",type=str,default=None,help="""Tab-delimited file with chromosome and position (bp) in the first two columns. Rows are written out with a cM column added""")
+    parser.add_argument("--header",action='store_true',help="""The positions file has a header line""")
+    parser.add_argument("--out",type=str,default=None,help="""Output file for --positions (Default: stdout)""")
+    parser.add_argument("--chunksize",type=int,default=100000,help="""Rows of the positions file converted at a time (Default: 100000)""")
     args = parser.parse_args()
+    if args.positions is None and (args.chrom is None or args.start is None or args.end is None):
+        parser.error("chrom, start and end are required without --positions")
     return args
 
 
-def approx_cM(chrom,start,end,ref='v4'):
+def read_map_table(path):
+    """Reads a genetic map as a pandas df with columns chr, pos and cM. Files whose first line
+    has commas are read as a csv with a header (i.e. data_files/ogut_map.csv), others as the
+    whitespace-delimited Ogut map (SNP_ID, SNP_newID, chr, pos, cM)"""
+    with open(path) as infile:
+        first=infile.readline()
+    if ',' in first:
+        gmap=pd.read_csv(path)
+    else:
+        gmap=pd.read_table(path,sep=r'\s+',header=None,names=['SNP_ID','SNP_newID','chr','pos','cM'])
+    gmap=gmap[['chr','pos','cM']].apply(pd.to_numeric,errors='coerce').dropna()
+    return gmap
+
+
+class GeneticMap(object):
+    """Marker positions (bp) and genetic positions (cM) of each chromosome, sorted by position.
+    cM is made non-decreasing along each chromosome so converted positions keep their order"""
+
+    def __init__(self,maps):
+        """maps: dict of chromosome to (positions, cM) arrays"""
+        self.maps={}
+        for c,(pos,cM) in maps.items():
+            pos=np.asarray(pos,dtype=float)
+            cM=np.asarray(cM,dtype=float)
+            order=np.argsort(pos,kind='stable')
+            pos,cM=pos[order],cM[order]
+            keep=np.concatenate(([True],np.diff(pos) > 0))
+            self.maps[str(c)]=(pos[keep],np.maximum.accumulate(cM[keep]))
+
+    @classmethod
+    def from_table(cls,gmap):
+        """Builds the map from a df with columns chr, pos and cM"""
+        chrom=gmap['chr'].values
+        if chrom.dtype.kind == 'f':
+            chrom=chrom.astype(np.int64)
+        chrom=chrom.astype(str)
+        return cls({c:(gmap['pos'].values[chrom == c],gmap['cM'].values[chrom == c]) for c in pd.unique(chrom)})
+
+    @classmethod
+    def load(cls,path,cache=True):
+        """Reads the map file at path, from its binary cache <path>.npz when that is newer
+        than the map. A missing or stale cache is rebuilt, if the directory is writable"""
+        cache_file=path+'.npz'
+        stat=os.stat(path)
+        if cache and os.path.isfile(cache_file):
+            with np.load(cache_file) as npz:
+                if int(npz['version']) == CACHE_VERSION and int(npz['size']) == stat.st_size and int(npz['mtime_ns']) == stat.st_mtime_ns:
+                    bounds=npz['bounds']
+                    return cls({c:(npz['pos'][s:e],npz['cM'][s:e]) for c,s,e in zip(npz['chroms'],bounds[:-1],bounds[1:])})
+        gmap=cls.from_table(read_map_table(path))
+        if cache:
+            gmap.save(cache_file,stat)
+        return gmap
+
+    def save(self,cache_file,stat):
+        """Writes the binary cache of the map read from a file with os.stat() result stat"""
+        chroms=list(self.maps)
+        bounds=np.cumsum([0]+[len(self.maps[c][0]) for c in chroms])
+        tmp='{0}.{1}.tmp.npz'.format(cache_file,os.getpid())
+        try:
+            np.savez(tmp,version=CACHE_VERSION,size=stat.st_size,mtime_ns=stat.st_mtime_ns,chroms=np.array(chroms,dtype=str),bounds=bounds,
+                     pos=np.concatenate([self.maps[c][0] for c in chroms]) if chroms else np.zeros(0),
+                     cM=np.concatenate([self.maps[c][1] for c in chroms]) if chroms else np.zeros(0))
+            os.replace(tmp,cache_file)
+        except OSError:
+            #The map is usable without a cache, i.e. in a read-only shared directory
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+
+    def __contains__(self,chrom):
+        return str(chrom) in self.maps
+
+    def chromosomes(self):
+        return list(self.maps)
+
+    def subset(self,chroms):
+        """GeneticMap of only chroms, i.e. to send to a worker process"""
+        return GeneticMap({str(c):self.maps[str(c)] for c in chroms})
+
+    def physical_to_cM(self,chrom,positions):
+        """Genetic positions (cM) of an array of physical positions (bp) on chrom by linear
+        interpolation between the closest map markers. Positions outside the map are
+        extrapolated from its first or last interval"""
+        if str(chrom) not in self.maps:
+            raise ValueError("Chromosome {0} is not in the genetic map".format(chrom))
+        pos,cM=self.maps[str(chrom)]
+        shape=np.shape(positions)
+        positions=np.atleast_1d(np.asarray(positions,dtype=float))
+        result=np.interp(positions,pos,cM)
+        if len(pos) > 1:
+            lo=positions < pos[0]
+            result[lo]=cM[0]+(positions[lo]-pos[0])*(cM[1]-cM[0])/(pos[1]-pos[0])
+            hi=positions > pos[-1]
+            result[hi]=cM[-1]+(positions[hi]-pos[-1])*(cM[-1]-cM[-2])/(pos[-1]-pos[-2])
+        return result.reshape(shape)
+
+    def distance(self,chrom,start,end):
+        """Genetic distances (cM) between arrays of start and end positions (bp) on chrom"""
+        return np.abs(self.physical_to_cM(chrom,end)-self.physical_to_cM(chrom,start))
+
+
+_maps={}
+
+
+def load_map(path=None,ref='v4'):
+    """Returns the GeneticMap of path (Default: the Ogut map for ref), reading it only on the
+    first call"""
+    if path is None:
+        path=OGUT_PATH.format(ref)
+    if path not in _maps:
+        _maps[path]=GeneticMap.load(path)
+    return _maps[path]
+
+
+def approx_cM(chrom,start,end,ref='v4',path=None):
     """Arguments:
     chr: (int) chromosome number 1..10
     start: (int) physical bp position of start
     end: (int) physical bp position of end (end>start)
     ref (optional): (str) reference version of physical positions (either v2,v3, or v4)
+    path (optional): (str) genetic map file (Default: the Ogut map for ref)
 
     Returns:
     The approximate genetic distance between the start and end positions based on the Ogut 2015 genetic map (int)
     """
-    ogutpath='/group/jrigrp/Share/annotations/genetic_map/ogut2015/ogut_fifthcM_map_agp{0}.txt'.format(ref)
-    ogutmap=pd.read_table(ogutpath,sep='\s+',header=None,
-                          names=['SNP_ID','SNP_newID','chr','pos','cM'])
-    ogutmap.dropna(axis=0,inplace=True)
-    ogutmap['chr']=pd.to_numeric(ogutmap['chr'])
-    ogutmap['pos']=pd.to_numeric(ogutmap['pos'])
-    #Grab the chromosome
-    cmap=ogutmap[ogutmap['chr']==chrom]
-    cmap.reset_index(inplace=True)
-    #Closest ogut map markers above and below the start and end postions
-    dist=[]
-    for p in [start,end]:
-        below=cmap.iloc[cmap[cmap['pos']<=p]['pos'].idxmax(),]
-        above=cmap.iloc[cmap[cmap['pos']>=p]['pos'].idxmin(),]
-        xpoints=[below['pos'],above['pos']]
-        ypoints=[below['cM'],above['cM']]
-        #Linear regression of genetic position on physical position using two closest points
-        slope,intercept,r_value,p_value,stderr = stats.linregress(xpoints,ypoints)
-        cM=slope*p + intercept
-        dist.append(cM)
-    #return the genetic distance
-    return abs(dist[1]-dist[0])
+    return float(load_map(path,ref).distance(chrom,start,end))
+
 
+def convert_positions(gmap,infile,outfile,header=False,chunksize=100000):
+    """Adds a cM column to a tab-delimited file of chromosome and position (first two columns),
+    chunksize rows at a time
+    Returns: number of rows converted"""
+    n=0
+    reader=pd.read_csv(infile,sep='\t',header=0 if header else None,chunksize=chunksize)
+    for i,chunk in enumerate(reader):
+        chrom=chunk.iloc[:,0].astype(str).values
+        pos=chunk.iloc[:,1].values
+        cM=np.empty(len(chunk))
+        for c in pd.unique(chrom):
+            rows=chrom == c
+            cM[rows]=gmap.physical_to_cM(c,pos[rows])
+        chunk['cM' if header else chunk.shape[1]]=cM
+        chunk.to_csv(outfile,sep='\t',index=False,header=header and i == 0)
+        n+=len(chunk)
+    return n
 
 
 if __name__ == "__main__":
     args=arg_parse()
-    distance=approx_cM(args.chrom,args.start,args.end,ref=args.ref)
-    print("The approximate genetic distance between {0} and {1} is {2} cM ({3} cM/bp)".format(int(args.start),int(args.end),round(distance,3),round(distance/(args.end-args.start),6)))
+    if args.positions is not None:
+        gmap=load_map(args.map,args.ref)
+        if args.out is None:
+            convert_positions(gmap,args.positions,sys.stdout,args.header,args.chunksize)
+        else:
+            with open(args.out,'w') as outfile:
+                n=convert_positions(gmap,args.positions,outfile,args.header,args.chunksize)
+            print("Converted {0} positions to {1}".format(n,args.out))
+    else:
+        distance=approx_cM(args.chrom,args.start,args.end,ref=args.ref,path=args.map)
+        print("The approximate genetic distance between {0} and {1} is {2} cM ({3} cM/bp)".format(int(args.start),int(args.end),round(distance,3),round(distance/(args.end-args.start),6)))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Runs bcftools for the scripts in this directory. A failed command raises BcftoolsError with
+the command and its stderr instead of returning empty output, stdout can be streamed line by
+line, and run_many() runs many commands concurrently with a limit on the number of processes.
+"""
+
+import asyncio
+import tempfile
+from subprocess import Popen,PIPE
+
+BCFTOOLS='bcftools'
+# Longest stdout line read by run_many(), vcf records with many samples can be long
+LINE_LIMIT=1 << 26
+
+
+class BcftoolsError(RuntimeError):
+    """A bcftools command that could not be started or exited with an error"""
+
+    def __init__(self,cmd,returncode,stderr):
+        self.cmd=cmd
+        self.returncode=returncode
+        self.stderr=stderr
+        RuntimeError.__init__(self,"{0} failed (exit code {1}): {2}".format(' '.join(cmd),returncode,stderr.strip()))
+
+
+def command(args):
+    return [BCFTOOLS]+[str(a) for a in args]
+
+
+def run(args):
+    """Runs bcftools with args
+    Returns: stdout and stderr (bytes), raises BcftoolsError if the command fails"""
+    cmd=command(args)
+    try:
+        process=Popen(cmd,stdout=PIPE,stderr=PIPE)
+    except OSError as e:
+        raise BcftoolsError(cmd,None,str(e))
+    stdout,stderr=process.communicate()
+    if process.returncode != 0:
+        raise BcftoolsError(cmd,process.returncode,stderr.decode())
+    return stdout,stderr
+
+
+def lines(args):
+    """Yields the stdout lines of bcftools with args (bytes, without the newline) as they are
+    written. Raises BcftoolsError once stdout ends if the command failed. Stopping early kills
+    the process"""
+    cmd=command(args)
+    with tempfile.TemporaryFile() as err:
+        try:
+            process=Popen(cmd,stdout=PIPE,stderr=err)
+        except OSError as e:
+            raise BcftoolsError(cmd,None,str(e))
+        done=False
+        try:
+            for line in process.stdout:
+                yield line.rstrip(b'\n')
+            done=True
+        finally:
+            process.stdout.close()
+            if not done:
+                process.kill()
+            returncode=process.wait()
+        if returncode != 0:
+            err.seek(0)
+            raise BcftoolsError(cmd,returncode,err.read().decode())
+
+
+async def _run_async(args,limit,index,on_line):
+    cmd=command(args)
+    async with limit:
+        try:
+            process=await asyncio.create_subprocess_exec(*cmd,stdout=PIPE,stderr=PIPE,limit=LINE_LIMIT)
+        except OSError as e:
+            raise BcftoolsError(cmd,None,str(e))
+        stderr=asyncio.ensure_future(process.stderr.read())
+        out=[]
+        try:
+            async for line in process.stdout:
+                if on_line is None:
+                    out.append(line)
+                else:
+                    on_line(index,line.rstrip(b'\n'))
+            returncode=await process.wait()
+            stderr=await stderr
+        except asyncio.CancelledError:
+            stderr.cancel()
+            process.kill()
+            await process.wait()
+            raise
+    if returncode != 0:
+        raise BcftoolsError(cmd,returncode,stderr.decode())
+    return b''.join(out)
+
+
+async def _run_many(jobs,limit,on_line):
+    limit=asyncio.Semaphore(limit)
+    tasks=[asyncio.ensure_future(_run_async(args,limit,i,on_line)) for i,args in enumerate(jobs)]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        #Stop the other commands before passing the error on
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks,return_exceptions=True)
+        raise
+
+
+def run_many(jobs,limit=4,on_line=None):
+    """Runs bcftools once for each list of args in jobs, at most limit at a time
+    Input:
+    jobs: list of bcftools argument lists
+    limit: (int) maximum number of bcftools processes at once
+    on_line: function called with (job index, line) for each stdout line as it is read.
+    Lines of different jobs interleave, but the lines of one job are in order
+
+    Returns: the stdout (bytes) of every job in the order of jobs, empty if on_line is given.
+    If a job fails, the others are stopped and its BcftoolsError is raised
+    """
+    return asyncio.run(_run_many(jobs,max(int(limit),1),on_line))
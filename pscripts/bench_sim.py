@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""
+Benchmarks the simulation hot paths of full_sim.py over a range of population sizes and
+numbers of chromosomes. Records wall time, throughput (lines/s) and peak memory, and appends
+them with the current git commit to a tab-delimited results file so runs can be compared
+across commits.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+from subprocess import Popen,PIPE
+import numpy as np
+import pandas as pd
+import full_sim
+
+
+def arg_parse():
+    parser=argparse.ArgumentParser(description="""Program description: Benchmarks the simulation functions in full_sim.py and saves the results for comparison across commits""")
+    parser.add_argument("--lines",type=int,nargs='+',default=[100,1000,10000,100000,1000000],help="""Population sizes to benchmark (Default: 100 1000 10000 100000 1000000)""")
+    parser.add_argument("--chroms",type=int,nargs='+',default=[1,10],help="""Numbers of chromosomes to benchmark (Default: 1 10)""")
+    parser.add_argument("--bench",type=str,nargs='+',default=None,help="""Benchmarks to run (Default: all). Options are {0}""".format(', '.join(BENCH_ORDER)))
+    parser.add_argument("--legacy-max",type=int,default=1000,help="""Largest population size for the list-based functions (chrom_info, crossover, make_magic, locations, make_outfile) (Default: 1000)""")
+    parser.add_argument("--founders",type=int,default=16,help="""Number of founders (Default: 16)""")
+    parser.add_argument("--no-memory",action='store_true',help="""Skip the peak memory measurement, which reruns every benchmark under tracemalloc""")
+    parser.add_argument("--out",type=str,default='bench_output.txt',help="""Results file, appended to (Default: bench_output.txt)""")
+    parser.add_argument("--compare",type=str,nargs='*',default=None,help="""Compare results instead of running: two commits to compare (Default: the last two commits in the results file)""")
+    parser.add_argument("--threshold",type=float,default=1.1,help="""Slowdown ratio reported as a regression by --compare (Default: 1.1)""")
+    args=parser.parse_args()
+    if args.compare is not None:
+        if args.compare and len(args.compare) != 2:
+            parser.error("--compare takes two commits, not {0}".format(len(args.compare)))
+        if not os.path.isfile(args.out):
+            parser.error("Results file {0} not found, run the benchmarks first".format(args.out))
+        if not args.compare and len(result_commits(args.out)) < 2:
+            parser.error("{0} holds results of fewer than two commits, run the benchmarks on another commit first".format(args.out))
+    return args
+
+
+def git_commit():
+    """Short hash of the checked out commit, with + appended if the tree has changes"""
+    process=Popen(['git','rev-parse','--short','HEAD'],stdout=PIPE,stderr=PIPE,cwd=os.path.dirname(os.path.abspath(__file__)))
+    stdout,stderr=process.communicate()
+    commit=stdout.decode().strip() or 'unknown'
+    process=Popen(['git','status','--porcelain','--untracked-files=no'],stdout=PIPE,stderr=PIPE,cwd=os.path.dirname(os.path.abspath(__file__)))
+    stdout,stderr=process.communicate()
+    if stdout.strip():
+        commit+='+'
+    return commit
+
+
+def founders(nf):
+    return full_sim.founder_codes(['F{0}'.format(i) for i in range(nf)])
+
+
+# Each benchmark takes (lines,chroms,founders) and returns a function that runs it once.
+# Legacy benchmarks work on one chromosome at a time, so they loop over chromosomes.
+
+def bench_chrom_info(n,nchrom,nf):
+    cent=full_sim.read_centromeres()
+    def run():
+        for i in range(n):
+            for c in range(1,nchrom+1):
+                full_sim.chrom_info(c,cent)
+    return run
+
+
+def bench_crossover(n,nchrom,nf):
+    pops=[full_sim.chrom_sim(['F0','F1'],2,c) for c in range(1,nchrom+1)]
+    def run():
+        for c in range(1,nchrom+1):
+            full_sim.crossover(n,pops[c-1],c)
+    return run
+
+
+def bench_make_magic(n,nchrom,nf):
+    names=['F{0}'.format(i) for i in range(nf)]
+    pops=[full_sim.chrom_sim(names,nf,c) for c in range(1,nchrom+1)]
+    def run():
+        for c in range(1,nchrom+1):
+            [full_sim.make_magic(pops[c-1],c) for i in range(n)]
+    return run
+
+
+def bench_locations(n,nchrom,nf):
+    codes,names=founders(nf)
+    lines=[full_sim.batch_magic(full_sim.chrom_array(codes,end),n,prior)
+           for prior,end in [full_sim.recomb_map(c).block_prior() for c in range(1,nchrom+1)]]
+    lines=[[list(names[r]) for r in l] for l in lines]
+    def run():
+        for c in range(nchrom):
+            for r in lines[c]:
+                full_sim.locations(r,c+1)
+    return run
+
+
+def bench_batch_magic(n,nchrom,nf):
+    codes,names=founders(nf)
+    maps=[full_sim.recomb_map(c).block_prior() for c in range(1,nchrom+1)]
+    def run():
+        for prior,end in maps:
+            full_sim.batch_magic(full_sim.chrom_array(codes,end),n,prior)
+    return run
+
+
+def bench_stahl_crossovers(n,nchrom,nf):
+    maps=[full_sim.recomb_map(c) for c in range(1,nchrom+1)]
+    def run():
+        rng=np.random.default_rng(1)
+        for rmap in maps:
+            full_sim.stahl_crossovers(n,rmap,rng)
+    return run
+
+
+def bench_run_design(n,nchrom,nf):
+    codes,names=founders(nf)
+    maps=[full_sim.recomb_map(c) for c in range(1,nchrom+1)]
+    def run():
+        rng=np.random.default_rng(1)
+        for rmap in maps:
+            full_sim.run_design(codes,n,'magic',rmap,rng)
+    return run
+
+
+def bench_make_outfile(n,nchrom,nf):
+    codes,names=founders(nf)
+    lines=[full_sim.batch_magic(full_sim.chrom_array(codes,end),n,prior)
+           for prior,end in [full_sim.recomb_map(c).block_prior() for c in range(1,nchrom+1)]]
+    lines=[[list(names[r]) for r in l] for l in lines]
+    out=os.path.join(tempfile.gettempdir(),'bench_sim_{0}.txt'.format(os.getpid()))
+    def run():
+        for l in lines:
+            full_sim.make_outfile(l,out)
+        os.remove(out)
+    return run
+
+
+def bench_sim_writer(n,nchrom,nf):
+    codes,names=founders(nf)
+    pop=full_sim.genome_sim(codes,n,range(1,nchrom+1),seed=1)
+    out=os.path.join(tempfile.gettempdir(),'bench_sim_{0}.txt.gz'.format(os.getpid()))
+    def run():
+        with full_sim.SimWriter(out,names,'gzip') as writer:
+            writer.write(pop)
+        os.remove(out)
+    return run
+
+
+BENCHMARKS={'chrom_info':(bench_chrom_info,True),
+            'crossover':(bench_crossover,True),
+            'make_magic':(bench_make_magic,True),
+            'locations':(bench_locations,True),
+            'batch_magic':(bench_batch_magic,False),
+            'stahl_crossovers':(bench_stahl_crossovers,False),
+            'run_design':(bench_run_design,False),
+            'make_outfile':(bench_make_outfile,True),
+            'sim_writer':(bench_sim_writer,False)}
+BENCH_ORDER=['chrom_info','crossover','make_magic','locations','make_outfile','batch_magic','stahl_crossovers','run_design','sim_writer']
+
+
+def time_bench(setup,n,nchrom,nf,memory=True):
+    """Runs one benchmark
+    Returns: wall time (s) and peak traced memory (Mb, None if memory is False)"""
+    run=setup(n,nchrom,nf)
+    start=time.time()
+    run()
+    seconds=time.time()-start
+    peak=None
+    if memory:
+        run=setup(n,nchrom,nf)
+        tracemalloc.start()
+        run()
+        peak=tracemalloc.get_traced_memory()[1]/1e6
+        tracemalloc.stop()
+    return seconds,peak
+
+
+def run_benchmarks(names,lines,chroms,nf,legacy_max,memory=True):
+    """Runs every benchmark in names for each population size and number of chromosomes
+    Returns: pandas df of results"""
+    commit=git_commit()
+    date=time.strftime('%Y-%m-%d %H:%M:%S')
+    rows=[]
+    for name in names:
+        setup,legacy=BENCHMARKS[name]
+        for nchrom in chroms:
+            for n in lines:
+                if legacy and n > legacy_max:
+                    continue
+                seconds,peak=time_bench(setup,n,nchrom,nf,memory)
+                row={'commit':commit,'date':date,'bench':name,'lines':n,'chroms':nchrom,'founders':nf,
+                     'seconds':round(seconds,4),'lines_per_s':round(n/seconds,1) if seconds > 0 else np.inf,
+                     'peak_mb':None if peak is None else round(peak,2)}
+                print('{bench}\t{lines}\t{chroms}\t{seconds}\t{lines_per_s}\t{peak_mb}'.format(**row))
+                rows.append(row)
+    return pd.DataFrame(rows,columns=['commit','date','bench','lines','chroms','founders','seconds','lines_per_s','peak_mb'])
+
+
+def save_results(df,out):
+    """Appends results to the tab-delimited file out, writing the header if it is new"""
+    df.to_csv(out,sep='\t',index=False,mode='a',header=not os.path.isfile(out))
+
+
+def result_commits(out):
+    """Commits in a results file from save_results(), in the order they were first run"""
+    return list(pd.unique(pd.read_table(out)['commit']))
+
+
+def compare(out,commits=None,threshold=1.1):
+    """Compares the wall time and peak memory of two commits in a results file
+    Input:
+    out: (str) results file from save_results()
+    commits: (list) the base and new commit (Default: the last two commits in the file)
+    threshold: (float) time ratio (new/base) above which a benchmark is a regression
+
+    Returns: pandas df with one row per benchmark run in both commits
+    """
+    df=pd.read_table(out)
+    if not commits:
+        commits=result_commits(out)[-2:]
+    if len(commits) != 2:
+        raise ValueError("Need two commits to compare, found {0}".format(', '.join(commits)))
+    key=['bench','lines','chroms','founders']
+    #Use the latest run of each benchmark in each commit
+    base=df[df['commit']==commits[0]].drop_duplicates(key,keep='last')
+    new=df[df['commit']==commits[1]].drop_duplicates(key,keep='last')
+    both=base.merge(new,on=key,suffixes=('_base','_new'))
+    both['time_ratio']=(both['seconds_new']/both['seconds_base']).round(3)
+    both['memory_ratio']=(both['peak_mb_new']/both['peak_mb_base']).round(3)
+    both['regression']=both['time_ratio'] > threshold
+    return both[key+['seconds_base','seconds_new','time_ratio','peak_mb_base','peak_mb_new','memory_ratio','regression']]
+
+
+if __name__ == "__main__":
+    args=arg_parse()
+    if args.compare is not None:
+        result=compare(args.out,args.compare,args.threshold)
+        print(result.to_string(index=False))
+        print("\n{0} of {1} benchmarks slower by more than {2}x".format(result['regression'].sum(),len(result),args.threshold))
+    else:
+        names=args.bench if args.bench else BENCH_ORDER
+        for name in names:
+            if name not in BENCHMARKS:
+                raise ValueError("{0} is not a valid benchmark. Please choose from {1}".format(name,', '.join(BENCH_ORDER)))
+        print('bench\tlines\tchroms\tseconds\tlines_per_s\tpeak_mb')
+        df=run_benchmarks(names,args.lines,args.chroms,args.founders,args.legacy_max,not args.no_memory)
+        save_results(df,args.out)
+        print("Results appended to {0}".format(args.out))
@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+"""
+Reads and writes BGZF, the blocked gzip format used by bgzip, tabix and bcftools.
+A BGZF file is a series of gzip members of at most 64Kb each, so it can be read by
+any gzip reader and still be accessed at random through virtual file offsets
+(compressed block offset << 16 | offset within the uncompressed block).
+"""
+
+import os
+import struct
+import zlib
+from collections import OrderedDict
+import numpy as np
+
+# Largest amount of uncompressed data put in one block, as in htslib
+BLOCK_DATA=0xff00
+EOF_BLOCK=b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+
+def compress_block(data,level=6):
+    """Compresses at most BLOCK_DATA bytes into one complete BGZF block"""
+    c=zlib.compressobj(level,zlib.DEFLATED,-15)
+    cdata=c.compress(data)+c.flush()
+    header=struct.pack('<4BI2BH2BHH',0x1f,0x8b,8,4,0,0,0xff,6,66,67,2,len(cdata)+25)
+    return header+cdata+struct.pack('<II',zlib.crc32(data) & 0xffffffff,len(data))
+
+
+class BgzfWriter(object):
+    """Writes a BGZF file block by block, keeping at most one block in memory"""
+
+    def __init__(self,path,level=6):
+        self.handle=open(path,'wb')
+        self.level=level
+        self.buffer=b''
+        self.block_start=0
+        self.data_start=0
+        # Uncompressed and compressed start of every block, for virtual_offsets()
+        self.blocks=[]
+
+    def write(self,data):
+        if not isinstance(data,bytes):
+            data=data.encode()
+        self.buffer+=data
+        start=0
+        while len(self.buffer)-start >= BLOCK_DATA:
+            self._write_block(self.buffer[start:start+BLOCK_DATA])
+            start+=BLOCK_DATA
+        if start:
+            self.buffer=self.buffer[start:]
+
+    def _write_block(self,data):
+        block=compress_block(data,self.level)
+        self.blocks.append((self.data_start,self.block_start))
+        self.handle.write(block)
+        self.block_start+=len(block)
+        self.data_start+=len(data)
+
+    def tell(self):
+        """Virtual offset of the next byte written"""
+        return (self.block_start << 16) | len(self.buffer)
+
+    def virtual_offsets(self,offsets):
+        """Virtual offsets of positions in the uncompressed data written so far (an array of
+        byte offsets from the start of the file). Positions still in the buffer are not
+        in a block yet, so call flush() or close() first"""
+        offsets=np.asarray(offsets,dtype=np.int64)
+        ustart=np.array([b[0] for b in self.blocks]+[self.data_start],dtype=np.int64)
+        cstart=np.array([b[1] for b in self.blocks]+[self.block_start],dtype=np.int64)
+        k=np.searchsorted(ustart,offsets,side='right')-1
+        return (cstart[k] << 16) | (offsets-ustart[k])
+
+    def flush(self):
+        """Ends the current block so the next write starts a new one"""
+        if self.buffer:
+            self._write_block(self.buffer)
+            self.buffer=b''
+
+    def close(self):
+        self.flush()
+        self.handle.write(EOF_BLOCK)
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+
+def reg2bin(beg,end):
+    """Tabix/BAI bin of the 0-based half-open intervals [beg,end), for arrays of intervals"""
+    beg=np.asarray(beg,dtype=np.int64)
+    end=np.asarray(end,dtype=np.int64)-1
+    conditions=[beg >> shift == end >> shift for shift in (14,17,20,23,26)]
+    choices=[offset+(beg >> shift) for shift,offset in ((14,4681),(17,585),(20,73),(23,9),(26,1))]
+    return np.select(conditions,choices,0)
+
+
+def write_tabix(path,names,tid,beg,end,vbeg,vend,preset='vcf'):
+    """Writes a tabix index (.tbi) of a sorted BGZF file
+    Input:
+    path: (str) index file, usually the data file + .tbi
+    names: sequence names, in the order they appear in the file
+    tid: index in names of the sequence of every record
+    beg,end: 0-based half-open interval of every record
+    vbeg,vend: virtual offsets of the start and end of every record (BgzfWriter.virtual_offsets())
+    preset: 'vcf' or 'bed', the column layout of the data file
+    """
+    fmt,col_seq,col_beg,col_end={'vcf':(2,1,2,0),'bed':(0x10000,1,2,3)}[preset]
+    tid=np.asarray(tid,dtype=np.int64)
+    beg=np.asarray(beg,dtype=np.int64)
+    end=np.asarray(end,dtype=np.int64)
+    vbeg=np.asarray(vbeg,dtype=np.uint64)
+    vend=np.asarray(vend,dtype=np.uint64)
+    bins=reg2bin(beg,end)
+    nm=b''.join(str(n).encode()+b'\0' for n in names)
+    out=[b'TBI\1',struct.pack('<8i',len(names),fmt,col_seq,col_beg,col_end,ord('#'),0,len(nm)),nm]
+    for t in range(len(names)):
+        rows=np.flatnonzero(tid == t)
+        # Runs of consecutive records in the same bin become one chunk
+        b=bins[rows]
+        starts=np.flatnonzero(np.concatenate(([True],b[1:] != b[:-1]))) if len(rows) else np.zeros(0,dtype=np.int64)
+        ends=np.append(starts[1:],len(rows))-1
+        chunks={}
+        for i,j in zip(starts,ends):
+            chunks.setdefault(int(b[i]),[]).append((int(vbeg[rows[i]]),int(vend[rows[j]])))
+        out.append(struct.pack('<i',len(chunks)))
+        for bin_id in sorted(chunks):
+            out.append(struct.pack('<Ii',bin_id,len(chunks[bin_id])))
+            out.extend(struct.pack('<QQ',cb,ce) for cb,ce in chunks[bin_id])
+        # Linear index: smallest offset of the records overlapping each 16Kb window
+        if len(rows):
+            first=beg[rows] >> 14
+            last=np.maximum(end[rows]-1,beg[rows]) >> 14
+            span=last-first+1
+            window=np.repeat(first,span)+np.arange(span.sum())-np.repeat(np.cumsum(span)-span,span)
+            ioff=np.full(int(last.max())+1,np.iinfo(np.uint64).max,dtype=np.uint64)
+            np.minimum.at(ioff,window,np.repeat(vbeg[rows],span))
+            empty=ioff == np.iinfo(np.uint64).max
+            ioff[empty]=0
+            # Empty windows take the offset of the window before them
+            ioff=ioff[np.maximum.accumulate(np.where(empty,0,np.arange(len(ioff))))]
+        else:
+            ioff=np.zeros(0,dtype=np.uint64)
+        out.append(struct.pack('<i',len(ioff)))
+        out.append(ioff.astype('<u8').tobytes())
+    with BgzfWriter(path) as writer:
+        writer.write(b''.join(out))
+
+
+class BgzfReader(object):
+    """Random access to a BGZF file by virtual offset, keeping the last cache_size
+    decompressed blocks in an LRU cache so nearby reads do not decompress blocks again"""
+
+    def __init__(self,path,cache_size=256):
+        self.handle=open(path,'rb')
+        self.size=os.fstat(self.handle.fileno()).st_size
+        self.cache_size=cache_size
+        self.cache=OrderedDict()
+
+    def read_block(self,coffset):
+        """Returns the uncompressed data of the block at compressed offset coffset and the
+        offset of the next block"""
+        if coffset in self.cache:
+            self.cache.move_to_end(coffset)
+            return self.cache[coffset]
+        self.handle.seek(coffset)
+        header=self.handle.read(12)
+        if len(header) < 12:
+            return b'',self.size
+        if header[:4] != b'\x1f\x8b\x08\x04':
+            raise ValueError("{0} is not BGZF, no block at offset {1}".format(self.handle.name,coffset))
+        xlen=struct.unpack('<H',header[10:12])[0]
+        extra=self.handle.read(xlen)
+        bsize=None
+        i=0
+        while i < xlen:
+            si1,si2,slen=struct.unpack('<BBH',extra[i:i+4])
+            if si1 == 66 and si2 == 67:
+                bsize=struct.unpack('<H',extra[i+4:i+6])[0]
+            i+=4+slen
+        if bsize is None:
+            raise ValueError("{0} is not BGZF, block at offset {1} has no size".format(self.handle.name,coffset))
+        rest=self.handle.read(bsize+1-12-xlen)
+        data=zlib.decompress(rest[:-8],-15)
+        block=(data,coffset+bsize+1)
+        self.cache[coffset]=block
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return block
+
+    def lines(self,voffset=0):
+        """Yields (virtual offset, line without the newline) of every line from voffset on"""
+        coffset,uoffset=voffset >> 16,voffset & 0xffff
+        data,next_block=self.read_block(coffset)
+        pending=b''
+        start=voffset
+        while True:
+            nl=data.find(b'\n',uoffset)
+            if nl >= 0:
+                yield start,pending+data[uoffset:nl]
+                pending=b''
+                uoffset=nl+1
+                start=(coffset << 16) | uoffset if uoffset < len(data) else next_block << 16
+                continue
+            pending+=data[uoffset:]
+            if next_block >= self.size:
+                break
+            coffset=next_block
+            data,next_block=self.read_block(coffset)
+            uoffset=0
+        if pending:
+            yield start,pending
+
+    def read_all(self):
+        """The whole uncompressed contents"""
+        out=[]
+        coffset=0
+        while coffset < self.size:
+            data,coffset=self.read_block(coffset)
+            out.append(data)
+        return b''.join(out)
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+
+def reg2bins(beg,end,min_shift=14,depth=5):
+    """All bins that may hold records overlapping the 0-based half-open interval [beg,end)"""
+    end-=1
+    bins=[]
+    shift=min_shift+depth*3
+    offset=0
+    for level in range(depth+1):
+        bins.extend(range(offset+(beg >> shift),offset+(end >> shift)+1))
+        shift-=3
+        offset+=1 << (level*3)
+    return bins
+
+
+def merge_spans(spans):
+    """Sorted union of (start,end) intervals, as a list of disjoint (start,end) intervals"""
+    merged=[]
+    for start,end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1]=max(merged[-1][1],end)
+        else:
+            merged.append([start,end])
+    return [tuple(m) for m in merged]
+
+
+class TabixIndex(object):
+    """A tabix (.tbi) or CSI (.csi) index: sequence names, column layout, and for each
+    sequence a dict of bin -> chunks (virtual offset ranges) and the linear index"""
+
+    def __init__(self,path):
+        with BgzfReader(path) as reader:
+            data=reader.read_all()
+        if data[:4] == b'TBI\1':
+            self.min_shift,self.depth=14,5
+            pos=4
+            n_ref=struct.unpack('<i',data[pos:pos+4])[0]
+            pos=self._header(data,pos+4)
+        elif data[:4] == b'CSI\1':
+            self.min_shift,self.depth,l_aux=struct.unpack('<3i',data[4:16])
+            self._header(data,16) if l_aux >= 28 else self._no_header()
+            pos=16+l_aux
+            n_ref=struct.unpack('<i',data[pos:pos+4])[0]
+            pos+=4
+        else:
+            raise ValueError("{0} is not a tabix or CSI index".format(path))
+        csi=data[:4] == b'CSI\1'
+        self.bins=[]
+        self.linear=[]
+        for r in range(n_ref):
+            n_bin=struct.unpack('<i',data[pos:pos+4])[0]
+            pos+=4
+            bins={}
+            for b in range(n_bin):
+                if csi:
+                    bin_id,loffset,n_chunk=struct.unpack('<IQi',data[pos:pos+16])
+                    pos+=16
+                else:
+                    bin_id,n_chunk=struct.unpack('<Ii',data[pos:pos+8])
+                    pos+=8
+                chunks=np.frombuffer(data,dtype='<u8',count=2*n_chunk,offset=pos).reshape(n_chunk,2)
+                pos+=16*n_chunk
+                bins[bin_id]=chunks
+            self.bins.append(bins)
+            if csi:
+                self.linear.append(np.zeros(0,dtype=np.uint64))
+            else:
+                n_intv=struct.unpack('<i',data[pos:pos+4])[0]
+                pos+=4
+                self.linear.append(np.frombuffer(data,dtype='<u8',count=n_intv,offset=pos))
+                pos+=8*n_intv
+        if len(self.names) < n_ref:
+            self.names+=[str(i) for i in range(len(self.names),n_ref)]
+        self.tid={n:i for i,n in enumerate(self.names)}
+
+    def _header(self,data,pos):
+        self.format,self.col_seq,self.col_beg,self.col_end,meta,self.skip,l_nm=struct.unpack('<7i',data[pos:pos+28])
+        self.meta=chr(meta)
+        self.names=[n.decode() for n in data[pos+28:pos+28+l_nm].split(b'\0')[:-1]]
+        return pos+28+l_nm
+
+    def _no_header(self):
+        self.format,self.col_seq,self.col_beg,self.col_end,self.meta,self.skip=0,1,2,3,'#',0
+        self.names=[]
+
+    def chunks(self,chrom,beg,end):
+        """Sorted, merged virtual offset ranges that hold every record of chrom overlapping [beg,end)"""
+        tid=self.tid.get(str(chrom))
+        if tid is None:
+            return []
+        bins=self.bins[tid]
+        found=[bins[b] for b in reg2bins(beg,end,self.min_shift,self.depth) if b in bins]
+        if not found:
+            return []
+        chunks=np.concatenate(found)
+        linear=self.linear[tid]
+        window=beg >> self.min_shift
+        min_off=int(linear[min(window,len(linear)-1)]) if len(linear) else 0
+        chunks=chunks[chunks[:,1] > min_off]
+        chunks=chunks[np.argsort(chunks[:,0],kind='stable')]
+        merged=[]
+        for cbeg,cend in chunks.tolist():
+            cbeg=max(cbeg,min_off)
+            if merged and cbeg <= merged[-1][1]:
+                merged[-1][1]=max(merged[-1][1],cend)
+            else:
+                merged.append([cbeg,cend])
+        return merged
+
+
+class TabixReader(object):
+    """Reads the records of a bgzipped, tabix or CSI indexed file (vcf, bed, ...) that overlap
+    regions, in-process instead of through bcftools or tabix. Decompressed blocks are kept
+    in an LRU cache, so many small regions of the same file are cheap"""
+
+    def __init__(self,path,index=None,cache_size=256):
+        if index is None:
+            index=path+'.tbi' if os.path.isfile(path+'.tbi') else path+'.csi'
+        self.index=TabixIndex(index)
+        self.reader=BgzfReader(path,cache_size)
+
+    @property
+    def names(self):
+        return self.index.names
+
+    def header(self):
+        """The header lines (starting with the meta character) as one string"""
+        meta=self.index.meta.encode()
+        out=[]
+        for voffset,line in self.reader.lines(0):
+            if not line.startswith(meta):
+                break
+            out.append(line.decode()+'\n')
+        return ''.join(out)
+
+    def interval(self,fields):
+        """0-based half-open interval of a record split into fields"""
+        ix=self.index
+        beg=int(fields[ix.col_beg-1])
+        if not ix.format & 0x10000:
+            beg-=1
+        if ix.format & 0xffff == 2:
+            end=beg+len(fields[3])
+        elif ix.col_end:
+            end=int(fields[ix.col_end-1])
+        else:
+            end=beg+1
+        return beg,end
+
+    def fetch_offsets(self,chrom,start=None,end=None):
+        """Yields (virtual offset, line) of the records of chrom overlapping the 0-based
+        half-open interval [start,end) (Default: the whole sequence)"""
+        start=0 if start is None else max(int(start),0)
+        end=(1 << 29) if end is None else int(end)
+        chrom=str(chrom)
+        meta=self.index.meta
+        ncols=max(self.index.col_seq,self.index.col_beg,self.index.col_end,4)
+        for cbeg,cend in self.index.chunks(chrom,start,end):
+            for voffset,line in self.reader.lines(cbeg):
+                if voffset >= cend:
+                    break
+                line=line.decode()
+                if line.startswith(meta):
+                    continue
+                fields=line.split('\t',ncols)
+                if fields[self.index.col_seq-1] != chrom:
+                    continue
+                beg,stop=self.interval(fields)
+                if beg >= end:
+                    break
+                if stop > start:
+                    yield voffset,line
+
+    def fetch(self,chrom,start=None,end=None):
+        """Yields the lines of the records of chrom overlapping [start,end), see fetch_offsets()"""
+        for voffset,line in self.fetch_offsets(chrom,start,end):
+            yield line
+
+    def fetch_regions(self,regions):
+        """Lines of the records overlapping any of regions ((chrom,start,end) 0-based half-open),
+        each once and in file order, like bcftools view -R. The regions of each sequence are
+        merged and read in order with scan_spans(), so nearby regions (i.e. one per marker)
+        are read in one sequential scan instead of each decoding again from its own offset"""
+        spans={}
+        for chrom,start,end in regions:
+            spans.setdefault(str(chrom),[]).append((max(int(start),0),int(end)))
+        found=[]
+        for chrom in spans:
+            found.extend(self.scan_spans(chrom,merge_spans(spans[chrom])))
+        found.sort()
+        return [line for voffset,line in found]
+
+    def scan_spans(self,chrom,spans):
+        """Yields (virtual offset, line) of the records of chrom overlapping any of spans, sorted
+        and disjoint (start,end) intervals. A span whose index chunk starts inside the part of
+        the file already read continues that sequential scan instead of decoding again from
+        the start of the chunk"""
+        meta=self.index.meta
+        ncols=max(self.index.col_seq,self.index.col_beg,self.index.col_end,4)
+        lines=None
+        first=0
+        record=None
+        seen=set()
+        for start,end in spans:
+            for cbeg,cend in self.index.chunks(chrom,start,end):
+                #record is the next unused record of the scan that started at first
+                if lines is None or cbeg < first or (record is not None and cbeg > record[0]):
+                    lines=self.reader.lines(cbeg)
+                    first=cbeg
+                    record=next(lines,None)
+                done=False
+                while record is not None:
+                    voffset,line=record
+                    if voffset >= cend:
+                        break
+                    line=line.decode()
+                    if not line.startswith(meta):
+                        fields=line.split('\t',ncols)
+                        if fields[self.index.col_seq-1] == chrom:
+                            beg,stop=self.interval(fields)
+                            if beg >= end:
+                                done=True
+                                break
+                            if stop > start and voffset not in seen:
+                                seen.add(voffset)
+                                yield voffset,line
+                    record=next(lines,None)
+                if done:
+                    break
+
+    def close(self):
+        self.reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
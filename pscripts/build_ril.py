@@ -4,17 +4,27 @@ Takes in a markerfile with a list of positions and a file from the output of Sim
 and creates vcf files that are a mixture of the two parents.
 
 """
-from subprocess import Popen, PIPE
+import bcftools_exec
 import pandas as pd
 import sys
 import argparse
 import numpy as np
+import build_simvcf
+import bgzf
 
 def get_args():
     parser=argparse.ArgumentParser(description="""Program description""")
     parser.add_argument("infile",type=str,help="""The input vcf file""")
     parser.add_argument("outfile",type=str,help="""The output vcf file""")
     parser.add_argument("markerfile",type=str,help=""""File with list of marker postions""")
+    parser.add_argument("--founders",type=str,default='hmp3_founders2/hmp3_founders_final.vcf.gz',help="""Vcf file with all of the founders as samples (Default: hmp3_founders2/hmp3_founders_final.vcf.gz)""")
+    parser.add_argument("--single-pass",action='store_true',help="""Read the founder genotypes from the --founders vcf once and build every sample from them, instead of calling bcftools for every sample and donor""")
+    parser.add_argument("--cache",action='store_true',help="""With --single-pass, read the founder genotypes from a binary cache next to the --founders vcf (see geno_cache.py), built on first use and rebuilt when the vcf changes""")
+    parser.add_argument("--multisample",action='store_true',help="""Write all samples to one position-sorted vcf (outfile) instead of one vcf per sample. Uses the single pass founder genotypes""")
+    parser.add_argument("--bgzf",action='store_true',help="""With --multisample, compress the vcf with BGZF and write a tabix index (outfile.tbi)""")
+    parser.add_argument("--window",type=int,default=10000,help="""With --multisample, number of sites genotyped and written at a time (Default: 10000)""")
+    parser.add_argument("--in-process",action='store_true',help="""Read the bgzipped, tabix or CSI indexed vcfs in-process (bgzf.TabixReader) instead of calling bcftools""")
+    parser.add_argument("--jobs",type=int,default=4,help="""Number of bcftools processes run at once to extract the donors of a sample (Default: 4)""")
     args = parser.parse_args()
     return args
 
@@ -42,50 +52,62 @@ def co_loc(breaks,c=10):
     return locs
 
 
-def marker_regions(pbreaks,markerfile,rfile,c=10):
-    markers=[]
-    with open(markerfile,'r') as infile:
-        for line in infile:
-            markers.append(line[:-1])
-    regions=""
-    for m in markers:
-        for i in pbreaks:
-            chrom=c
-            start=i[1]
-            end=i[2]
-            if int(m) >= start and int(m) <=end:
-                regions+='{0}\t{1}\n'.format(chrom,m)
-    with open(rfile,'w') as outfile:
-    	outfile.write(regions)
+def long_table(bedfile):
+    """Converts the wide table (chr, start, end, one donor column per sample) to the
+    sample, chr, start, end, donor1, donor2 table read by build_simvcf.single_pass()"""
+    df=bedfile.melt(id_vars=['chr','start','end'],value_vars=list(bedfile.columns[3:]),var_name='sample',value_name='donor1')
+    df['donor2']=df['donor1']
+    return df[['sample','chr','start','end','donor1','donor2']]
 
 
-def bcftools_view(donorfile,regionsfile=None,header=False):
+def view_args(donorfile,regionsfile=None,header=False):
+    """bcftools arguments of bcftools_view()"""
     if header ==True:
-        process = Popen(['bcftools','view','-h',donorfile],stdout=PIPE,stderr=PIPE)
-    else:
-        process = Popen(['bcftools','view','-H','-R',regionsfile,donorfile],stdout=PIPE,stderr=PIPE)
-    stdout,stderr = process.communicate()
-    return stdout,stderr
+        return ['view','-h',donorfile]
+    return ['view','-H','-R',regionsfile,donorfile]
+
+
+def bcftools_view(donorfile,regionsfile=None,header=False):
+    return bcftools_exec.run(view_args(donorfile,regionsfile,header))
 
 
 def main():
     args=get_args()
     bedfile = pd.read_table('{0}'.format(args.infile),sep='\t')
+    if args.single_pass or args.multisample:
+        build_simvcf.single_pass(long_table(bedfile),args.founders,args.outfile,args.markerfile,cache=args.cache,
+                                 multisample=args.multisample,window=args.window,compress=args.bgzf,in_process=args.in_process)
+        return
     samples = bedfile.columns[3:]
-    header,stderr=bcftools_view(donorfile='hmp3_founders2/hmp3_founders_final.vcf.gz',header=True)
-    print(stderr)
+    markers=build_simvcf.read_markers(args.markerfile)
+    if args.in_process:
+        with bgzf.TabixReader(args.founders) as reader:
+            header=reader.header().encode()
+        readers={}
+    else:
+        header,stderr=bcftools_view(donorfile=args.founders,header=True)
+        print(stderr)
     for sample in samples:
         breaks = co_loc(bedfile[["start",sample]])
         vcf = header
         parents = bedfile[sample].unique()
+        jobs=[]
         for i in parents:
             pbreaks=[j for j in breaks if j[3]==i]
+            if args.in_process:
+                #Readers stay open across samples, so their block caches are reused
+                donorfile='hmp3_founders2/{0}_c10_hmp321_final.vcf.gz'.format(i)
+                if donorfile not in readers:
+                    readers[donorfile]=bgzf.TabixReader(donorfile)
+                vcf+=build_simvcf.tabix_view(readers[donorfile],pbreaks,markers,c=10)
+                continue
             regionsfile='{0}_regions.txt'.format(i)
-            marker_regions(pbreaks=pbreaks,markerfile=args.markerfile,rfile=regionsfile,c=10)
-            positions,stderr=bcftools_view(donorfile='hmp3_founders2/{0}_c10_hmp321_final.vcf.gz'.format(i),regionsfile=regionsfile)
-            print(stderr)
-	    vcf+=positions
-        with open('{0}_{1}'.format(sample,args.outfile),'w') as outfile:
+            build_simvcf.marker_regions(pbreaks=pbreaks,markers=markers,rfile=regionsfile,c=10)
+            jobs.append(view_args(donorfile='hmp3_founders2/{0}_c10_hmp321_final.vcf.gz'.format(i),regionsfile=regionsfile))
+        #The donors of a sample are extracted concurrently, and added in the order of parents
+        for positions in bcftools_exec.run_many(jobs,args.jobs):
+            vcf+=positions
+        with open('{0}_{1}'.format(sample,args.outfile),'wb') as outfile:
             outfile.write(vcf)
 
 
@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 
-from subprocess import Popen, PIPE
+import bcftools_exec
+from io import BytesIO,StringIO
 import pandas as pd
 import sys
 import argparse
 import numpy as np
+import geno_cache
+import bgzf
 
 def get_args():
     parser=argparse.ArgumentParser(description="""Program description""")
@@ -13,6 +16,14 @@ def get_args():
     parser.add_argument("donorpath",type=str,help="""The path to the location of the donor files""")
     parser.add_argument("--markerfile",type=str,help=""""File with list of marker postions""")
     parser.add_argument("--all",type=bool,help="""If True, use all of the marker positions available in the donor files""")
+    parser.add_argument("--founders",type=str,default='../biogemma/BiogemmaFounders_600K_Genotypes_AGPv4.vcf.gz',help="""Vcf file with all of the founders as samples (Default: ../biogemma/BiogemmaFounders_600K_Genotypes_AGPv4.vcf.gz)""")
+    parser.add_argument("--single-pass",action='store_true',help="""Read the founder genotypes from the --founders vcf once and build every sample from them, instead of calling bcftools for every sample and donor""")
+    parser.add_argument("--cache",action='store_true',help="""With --single-pass, read the founder genotypes from a binary cache next to the --founders vcf (see geno_cache.py), built on first use and rebuilt when the vcf changes""")
+    parser.add_argument("--multisample",action='store_true',help="""Write all samples to one position-sorted vcf (outfile) instead of one vcf per sample. Uses the single pass founder genotypes""")
+    parser.add_argument("--bgzf",action='store_true',help="""With --multisample, compress the vcf with BGZF and write a tabix index (outfile.tbi)""")
+    parser.add_argument("--window",type=int,default=10000,help="""With --multisample, number of sites genotyped and written at a time. Memory grows with the window times the number of samples, lower it for large populations (Default: 10000)""")
+    parser.add_argument("--in-process",action='store_true',help="""Read the bgzipped, tabix or CSI indexed vcfs in-process (bgzf.TabixReader) instead of calling bcftools""")
+    parser.add_argument("--jobs",type=int,default=4,help="""Number of bcftools processes run at once to extract the donors of a sample (Default: 4)""")
     args = parser.parse_args()
     return args
 
@@ -34,21 +45,30 @@ def co_loc(sample,bedfile):
     return locs,parents
 
     
-def marker_regions(pbreaks,markerfile,rfile,c=10):
-    markers=[]
+def read_markers(markerfile):
+    """Reads the list of marker positions once, as a sorted int64 array"""
     with open(markerfile,'r') as infile:
-        for line in infile:
-            markers.append(line[:-1])
-    regions=""
-    for m in markers:
-        for i in pbreaks:
-            chrom=c
-            start=i[1]
-            end=i[2]
-            if int(m) >= start and int(m) <=end:
-                regions+='{0}\t{1}\n'.format(chrom,m)
+        return np.sort(np.array([int(line) for line in infile if line.strip()],dtype=np.int64))
+
+
+def region_markers(pbreaks,markers):
+    """The markers inside the intervals of pbreaks ([[chromosome,start,end,donor],...]), found by
+    binary search of the sorted array from read_markers(), both ends included"""
+    starts=np.array([i[1] for i in pbreaks],dtype=np.int64)
+    ends=np.array([i[2] for i in pbreaks],dtype=np.int64)
+    lo=np.searchsorted(markers,starts,side='left')
+    hi=np.searchsorted(markers,ends,side='right')
+    counts=np.maximum(hi-lo,0)
+    #Index of every marker of every interval, without looping over the intervals
+    idx=np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts,counts)+np.repeat(lo,counts)
+    return np.sort(markers[idx])
+
+
+def marker_regions(pbreaks,markers,rfile,c=10):
+    """Writes the markers inside the intervals of pbreaks as a bcftools regions file"""
+    hits=region_markers(pbreaks,markers)
     with open(rfile,'w') as outfile:
-    	outfile.write(regions)
+        outfile.write(''.join('{0}\t{1}\n'.format(c,m) for m in hits.tolist()))
 
         
 def all_regions(pbreaks,rfile):
@@ -59,35 +79,319 @@ def all_regions(pbreaks,rfile):
         outfile.write(txt)
         
 
-def bcftools_view(donorfile,regionsfile=None,header=False):
+def tabix_view(reader,pbreaks,markers=None,c=10):
+    """In-process bcftools_view() of an indexed vcf opened as a bgzf.TabixReader: the records at
+    the markers inside pbreaks, or inside the whole of pbreaks if markers is None"""
+    if markers is None:
+        regions=[(i[0],int(i[1])-1,int(i[2])) for i in pbreaks]
+    else:
+        regions=[(c,m-1,m) for m in region_markers(pbreaks,markers).tolist()]
+    return ''.join(line+'\n' for line in reader.fetch_regions(regions)).encode()
+
+
+def view_args(donorfile,regionsfile=None,header=False):
+    """bcftools arguments of bcftools_view()"""
     if header ==True:
-        process = Popen(['bcftools','view','-h',donorfile],stdout=PIPE,stderr=PIPE)
+        return ['view','-h',donorfile]
+    return ['view','-H','-R',regionsfile,donorfile]
+
+
+def bcftools_view(donorfile,regionsfile=None,header=False):
+    return bcftools_exec.run(view_args(donorfile,regionsfile,header))
+
+
+def write_sites(markers,rfile,c=10):
+    """Writes the marker positions from read_markers() as a bcftools regions file of chromosome c"""
+    with open(rfile,'w') as outfile:
+        outfile.write(''.join('{0}\t{1}\n'.format(c,m) for m in markers.tolist()))
+
+
+def founder_matrix(vcf,founders,regionsfile=None):
+    """Reads the genotypes of all founders in one pass of bcftools query over a multi-sample vcf
+    Input:
+    vcf: vcf file with the founders as samples
+    founders: founder (sample) names
+    regionsfile: bcftools regions file of the sites to read (Default: all sites)
+
+    Output:
+    sites: pandas df of the sites read (chrom, pos, id, ref, alt)
+    geno: founders x sites int8 matrix of the allele of each founder's call, -1 if missing
+    """
+    stdout,stderr = bcftools_exec.run(['query','-l',vcf])
+    #bcftools keeps the order of the vcf header, not the order given to -s
+    order=[f for f in stdout.decode().split() if f in set(founders)]
+    missing=[f for f in founders if f not in order]
+    if missing:
+        raise ValueError("Donors {0} are not samples in {1}".format(', '.join(map(str,missing)),vcf))
+    cmd=['query','-s',','.join(founders),'-f','%CHROM\t%POS\t%ID\t%REF\t%ALT[\t%GT]\n']
+    if regionsfile is not None:
+        cmd+=['-R',regionsfile]
+    stdout,stderr = bcftools_exec.run(cmd+[vcf])
+    if not stdout:
+        return pd.DataFrame({'chrom':[],'pos':np.zeros(0,dtype=np.int64),'id':[],'ref':[],'alt':[]}),np.zeros((len(founders),0),dtype=np.int8)
+    table=pd.read_csv(BytesIO(stdout),sep='\t',header=None,dtype=str,keep_default_na=False)
+    sites=table.iloc[:,:5]
+    sites.columns=['chrom','pos','id','ref','alt']
+    sites=sites.assign(pos=sites['pos'].astype(np.int64))
+    #Founders are inbred, so the first allele stands for the call
+    geno=np.ascontiguousarray(geno_cache.decode_gt(table.iloc[:,5:].values)[:,:,0].T[[order.index(f) for f in founders]])
+    return sites,geno
+
+
+def tabix_founder_matrix(vcf,founders,markers=None,c=10):
+    """founder_matrix() read in-process from the bgzipped, indexed vcf with bgzf.TabixReader
+    markers: marker positions on chromosome c from read_markers() (Default: all sites)"""
+    with bgzf.TabixReader(vcf) as reader:
+        samples=reader.header().rstrip('\n').split('\n')[-1].split('\t')[9:]
+        if markers is None:
+            lines=[line.decode() for voffset,line in reader.reader.lines(0) if not line.startswith(b'#')]
+        else:
+            lines=reader.fetch_regions([(c,m-1,m) for m in markers.tolist()])
+    cols=pd.Index(samples).get_indexer(founders)
+    if (cols < 0).any():
+        raise ValueError("Donors {0} are not samples in {1}".format(', '.join(str(f) for f,i in zip(founders,cols) if i < 0),vcf))
+    if not lines:
+        return pd.DataFrame({'chrom':[],'pos':np.zeros(0,dtype=np.int64),'id':[],'ref':[],'alt':[]}),np.zeros((len(founders),0),dtype=np.int8)
+    table=pd.read_csv(StringIO('\n'.join(lines)),sep='\t',header=None,dtype=str,keep_default_na=False)
+    sites=table.iloc[:,[0,1,2,3,4]]
+    sites.columns=['chrom','pos','id','ref','alt']
+    sites=sites.assign(pos=sites['pos'].astype(np.int64))
+    geno=np.ascontiguousarray(geno_cache.decode_gt(table.iloc[:,9+cols].values)[:,:,0].T)
+    return sites,geno
+
+
+def cached_founder_matrix(vcf,founders,markers=None,c=10):
+    """founder_matrix() read from the binary genotype cache of vcf (see geno_cache.py),
+    which is built on first use and rebuilt when vcf changes
+    markers: marker positions on chromosome c from read_markers() (Default: all sites)"""
+    cache=geno_cache.open_cache(vcf)
+    cols=cache.sample_index(founders)
+    if markers is None:
+        rows=np.arange(len(cache))
     else:
-        process = Popen(['bcftools','view','-H','-R',regionsfile,donorfile],stdout=PIPE,stderr=PIPE)
-    stdout,stderr = process.communicate()
-    return stdout,stderr
+        rows=cache.lookup(c,markers)
+        rows=rows[rows >= 0]
+    return cache.sites(rows),np.ascontiguousarray(cache.geno[rows][:,cols,0].T)
+
+
+class SiteIndex(object):
+    """Sorted (chromosome, position) keys of the sites, to find the breakpoint interval
+    that covers each site with one binary search"""
+
+    def __init__(self,sites):
+        self.chroms=pd.Index(pd.unique(sites['chrom'].astype(str)))
+        self.pos=sites['pos'].values.astype(np.int64)
+        self.code=self.chroms.get_indexer(sites['chrom'].astype(str)).astype(np.int64)
+        self.width=np.int64(self.pos.max())+2 if len(self.pos) else np.int64(1)
+
+    def donors(self,breaks,founders,column='donor1'):
+        """Founder index of the donor in column of breaks (chr, start, end, donors) at
+        every site, -1 where no interval covers the site or the donor is not in founders.
+        Intervals include both start and end, as in the outfiles of full_sim.py"""
+        code=self.chroms.get_indexer(breaks['chr'].astype(str)).astype(np.int64)
+        ok=code >= 0
+        start=np.minimum(breaks['start'].values.astype(np.int64)[ok],self.width-1)
+        key=code[ok]*self.width+start
+        order=np.argsort(key,kind='stable')
+        key=key[order]
+        end=breaks['end'].values.astype(np.int64)[ok][order]
+        donor=pd.Index(founders).get_indexer(breaks[column])[ok][order]
+        idx=np.searchsorted(key,self.code*self.width+self.pos,side='right')-1
+        safe=np.maximum(idx,0)
+        found=(idx >= 0) & (key[safe]//self.width == self.code) & (self.pos <= end[safe])
+        return np.where(found,donor[safe],-1)
+
+
+class PopulationIndex(object):
+    """The breakpoint intervals of every sample in one sorted key array of (sample, chromosome,
+    start), to find the donors of all samples at a window of sites with one binary search"""
+
+    def __init__(self,bedfile,samples,founders,sites):
+        self.sites=sites
+        self.nsamples=len(samples)
+        s=pd.Index(samples).get_indexer(bedfile['sample'])
+        code=sites.chroms.get_indexer(bedfile['chr'].astype(str)).astype(np.int64)
+        ok=(s >= 0) & (code >= 0)
+        self.span=np.int64(len(sites.chroms))*sites.width
+        start=np.minimum(bedfile['start'].values.astype(np.int64)[ok],sites.width-1)
+        key=s[ok]*self.span+code[ok]*sites.width+start
+        order=np.argsort(key,kind='stable')
+        self.key=key[order]
+        self.end=bedfile['end'].values.astype(np.int64)[ok][order]
+        self.donor1=pd.Index(founders).get_indexer(bedfile['donor1'])[ok][order]
+        self.donor2=pd.Index(founders).get_indexer(bedfile['donor2'])[ok][order]
+
+    def donors(self,rows,block=1 << 20):
+        """Founder indexes of donor1 and donor2 of every sample at the sites in rows, as two
+        samples x sites int32 arrays, -1 where no interval covers the site. Samples are
+        searched in groups of about block sample x site pairs, which bounds the temporary arrays"""
+        site=self.sites.code[rows]*self.sites.width+self.sites.pos[rows]
+        pos=self.sites.pos[rows][None,:]
+        d1=np.empty((self.nsamples,len(rows)),dtype=np.int32)
+        d2=np.empty((self.nsamples,len(rows)),dtype=np.int32)
+        step=max(block//max(len(rows),1),1)
+        for s0 in range(0,self.nsamples,step):
+            s1=min(s0+step,self.nsamples)
+            q=np.arange(s0,s1,dtype=np.int64)[:,None]*self.span+site[None,:]
+            idx=np.searchsorted(self.key,q,side='right')-1
+            safe=np.maximum(idx,0)
+            #Same sample and chromosome, and the site is not past the end of the interval
+            found=(idx >= 0) & (self.key[safe]//self.sites.width == q//self.sites.width) & (pos <= self.end[safe])
+            d1[s0:s1]=np.where(found,self.donor1[safe],-1)
+            d2[s0:s1]=np.where(found,self.donor2[safe],-1)
+        return d1,d2
+
+
+def gt_table(geno):
+    """GT string of every pair of allele codes in geno, shifted by one so -1 (missing) is row 0"""
+    n=int(geno.max())+2 if geno.size else 1
+    return np.array([['./.' if i == 0 or j == 0 else '{0}/{1}'.format(i-1,j-1) for j in range(n)] for i in range(n)],dtype=object)
+
+
+def write_population(bedfile,sites,geno,header,outfile,window=10000,compress=False):
+    """Writes every sample in bedfile to one multi-sample vcf, sorted by position, a window of
+    sites at a time. Memory grows with the breakpoint tables and with window x samples, as
+    the genotype strings of every sample at a window of sites are built at once.
+    Sites not covered by a sample's breakpoints are missing (./.)
+    Input:
+    bedfile: pandas df (sample, chr, start, end, donor1, donor2)
+    sites,geno: output of founder_matrix() for the founders in bedfile
+    header: header of the founder vcf
+    outfile: (str) output vcf
+    window: (int) number of sites genotyped and written at a time
+    compress: (bool) write BGZF and a tabix index (outfile.tbi)
+    """
+    samples=list(pd.unique(bedfile['sample']))
+    founders=list(pd.unique(pd.concat([bedfile['donor1'],bedfile['donor2']])))
+    index=SiteIndex(sites)
+    population=PopulationIndex(bedfile,samples,founders,index)
+    order=np.lexsort((index.pos,index.code))
+    prefixes=site_prefixes(sites)
+    table=gt_table(geno)
+    lengths=[]
+    out=bgzf.BgzfWriter(outfile) if compress else open(outfile,'w')
+    with out:
+        text=vcf_header(header,samples)
+        out.write(text)
+        start=len(text.encode())
+        for w in range(0,len(order),window):
+            rows=order[w:w+window]
+            d1,d2=population.donors(rows)
+            cols=rows[None,:]
+            a1=np.where(d1 >= 0,geno[np.maximum(d1,0),cols],-1)
+            a2=np.where(d2 >= 0,geno[np.maximum(d2,0),cols],-1)
+            gt=table[a1+1,a2+1].T
+            lines=[p+'\t'.join(g)+'\n' for p,g in zip(prefixes[rows].tolist(),gt.tolist())]
+            lengths.extend(len(l.encode()) for l in lines)
+            out.write(''.join(lines))
+    if compress:
+        ends=start+np.cumsum(np.array(lengths,dtype=np.int64))
+        voff=out.virtual_offsets(np.concatenate(([start],ends)))
+        beg=index.pos[order]-1
+        bgzf.write_tabix(outfile+'.tbi',list(index.chroms),index.code[order],beg,beg+sites['ref'].str.len().values[order],voff[:-1],voff[1:])
+
+
+def sample_genotypes(geno,d1,d2):
+    """GT strings of a line at every site from the founder indexes of its two donors,
+    and whether both donors are known at the site"""
+    cols=np.arange(geno.shape[1])
+    a1=np.where(d1 >= 0,geno[np.maximum(d1,0),cols],-1)
+    a2=np.where(d2 >= 0,geno[np.maximum(d2,0),cols],-1)
+    return gt_table(geno)[a1+1,a2+1],(d1 >= 0) & (d2 >= 0)
+
+
+def vcf_header(header,samples):
+    """The header of the founder vcf with the sample columns replaced by samples"""
+    if isinstance(header,bytes):
+        header=header.decode()
+    lines=header.rstrip('\n').split('\n')
+    lines[-1]='\t'.join(lines[-1].split('\t')[:9]+list(samples))
+    return '\n'.join(lines)+'\n'
+
+
+def site_prefixes(sites):
+    """The fixed columns of a vcf record for every site, ending in the FORMAT column"""
+    return (sites['chrom'].astype(str)+'\t'+sites['pos'].astype(str)+'\t'+sites['id']+'\t'+sites['ref']+'\t'+sites['alt']+'\t.\t.\t.\tGT\t').values
+
+
+def compose_vcf(header,prefixes,gt,covered):
+    """Vcf text of one line: the records of the sites covered by its breakpoints"""
+    return header+''.join(prefixes[covered]+gt[covered]+'\n')
+
+
+def single_pass(bedfile,founder_vcf,outfile,markerfile=None,c=10,cache=False,multisample=False,window=10000,compress=False,in_process=False):
+    """Builds the vcf of every sample in bedfile (sample, chr, start, end, donor1, donor2)
+    from one read of the founder genotypes, instead of one bcftools call per sample and donor.
+    With cache, the genotypes are read from the binary cache of founder_vcf, with in_process
+    from the indexed founder_vcf without bcftools. With multisample,
+    all samples are written to outfile by write_population() instead of one file per sample"""
+    founders=list(pd.unique(pd.concat([bedfile['donor1'],bedfile['donor2']])))
+    if cache:
+        sites,geno=cached_founder_matrix(founder_vcf,founders,None if markerfile is None else read_markers(markerfile),c)
+    elif in_process:
+        sites,geno=tabix_founder_matrix(founder_vcf,founders,None if markerfile is None else read_markers(markerfile),c)
+    else:
+        regionsfile=None
+        if markerfile is not None:
+            regionsfile='{0}_sites.txt'.format(outfile)
+            write_sites(read_markers(markerfile),regionsfile,c)
+        sites,geno=founder_matrix(founder_vcf,founders,regionsfile)
+    if in_process:
+        with bgzf.TabixReader(founder_vcf) as reader:
+            header=reader.header()
+    else:
+        header,stderr=bcftools_view(donorfile=founder_vcf,header=True)
+    if multisample:
+        write_population(bedfile,sites,geno,header,outfile,window,compress)
+        return
+    index=SiteIndex(sites)
+    prefixes=site_prefixes(sites)
+    for sample,s in bedfile.groupby('sample',sort=False):
+        gt,covered=sample_genotypes(geno,index.donors(s,founders,'donor1'),index.donors(s,founders,'donor2'))
+        with open('{0}_{1}'.format(sample,outfile),'w') as out:
+            out.write(compose_vcf(vcf_header(header,[sample]),prefixes,gt,covered))
 
 
 def main():
     args=get_args()
     bedfile = pd.read_table('{0}'.format(args.infile),sep='\t')
+    if args.single_pass or args.multisample:
+        single_pass(bedfile,args.founders,args.outfile,None if args.all else args.markerfile,cache=args.cache,
+                    multisample=args.multisample,window=args.window,compress=args.bgzf,in_process=args.in_process)
+        return
     samples = bedfile['sample'].unique()
-    header,stderr=bcftools_view(donorfile='../biogemma/BiogemmaFounders_600K_Genotypes_AGPv4.vcf.gz',header=True)
-    print(stderr)
+    if not args.all:
+        markers=read_markers(args.markerfile)
+    if args.in_process:
+        with bgzf.TabixReader(args.founders) as reader:
+            header=reader.header().encode()
+        readers={}
+    else:
+        header,stderr=bcftools_view(donorfile=args.founders,header=True)
+        print(stderr)
     for sample in samples:
         vcf = header
         breaks,parents = co_loc(sample,bedfile)
+        jobs=[]
         for i in parents:
             pbreaks = [j for j in breaks if j[3]==i]        
+            if args.in_process:
+                #Readers stay open across samples, so their block caches are reused
+                donorfile='{0}/{1}_600K_Genotypes_AGPv4.vcf.gz'.format(args.donorpath,i)
+                if donorfile not in readers:
+                    readers[donorfile]=bgzf.TabixReader(donorfile)
+                vcf+=tabix_view(readers[donorfile],pbreaks,None if args.all else markers,c=10)
+                continue
             regionsfile='{0}_{1}_regions.txt'.format(i,sample)
             if args.all == True:
                 all_regions(pbreaks=pbreaks,rfile=regionsfile)
             else:
-                marker_regions(pbreaks=pbreaks,markerfile=args.markerfile,rfile=regionsfile,c=10)
-            positions,stderr=bcftools_view(donorfile='{0}/{1}_600K_Genotypes_AGPv4.vcf.gz'.format(args.donorpath,i),regionsfile=regionsfile)
-            print(stderr)
-	    vcf+=positions
-        with open('{0}_{1}'.format(sample,args.outfile),'w') as outfile:
+                marker_regions(pbreaks=pbreaks,markers=markers,rfile=regionsfile,c=10)
+            jobs.append(view_args(donorfile='{0}/{1}_600K_Genotypes_AGPv4.vcf.gz'.format(args.donorpath,i),regionsfile=regionsfile))
+        #The donors of a sample are extracted concurrently, and added in the order of parents
+        for positions in bcftools_exec.run_many(jobs,args.jobs):
+            vcf+=positions
+        with open('{0}_{1}'.format(sample,args.outfile),'wb') as outfile:
             outfile.write(vcf)
 
 
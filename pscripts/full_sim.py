@@ -4,23 +4,44 @@ import pandas as pd
 import numpy as np
 import argparse
 import os.path
+import gzip
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
+from bgzf import BgzfWriter
 
 
 def arg_parse():
     parser=argparse.ArgumentParser(description="""full_sim.py takes simulates a MAGIC or RIL population""")
     parser.add_argument("-f",type=str,help="""file containing names of parents to build lines from (one per line)""")
     parser.add_argument("-n",type=int,help="""Number of lines to procuce (int)""")
-    parser.add_argument("-t",type=str,help="""Type of lines to simulate. Options are 'magic' or 'ril'""")
+    parser.add_argument("-t",type=str,default='magic',help="""Breeding design to simulate. Either 'magic' (funnel then doubled haploids), 'ril' (funnel then 6 generations of selfing) or comma separated steps, i.e. 'funnel,intercross:2,dh'. See parse_design() (Default: magic)""")
+    parser.add_argument("-m",type=str,default='centromere',help="""Source of the recombination map. Options are 'centromere' (B73v4centromeres.txt), 'recomb' (recomb_prob_est.csv) or 'ogut' (ogut_map.csv) (Default: centromere)""")
+    parser.add_argument("-c",type=int,nargs='+',default=[10],help="""Chromosomes to simulate (Default: 10)""")
+    parser.add_argument("--genome",action='store_true',help="""Simulate all 10 maize chromosomes""")
+    parser.add_argument("--seed",type=int,default=None,help="""Master random seed. Output is identical for a given seed whatever the number of workers""")
+    parser.add_argument("--workers",type=int,default=1,help="""Number of worker processes (Default: 1)""")
+    parser.add_argument("--interference",type=float,nargs=2,default=[4,0.0],metavar=('M','P'),help="""Parameters of the chi-square (m) and Housworth-Stahl escape (p) crossover interference model (Default: 4 0)""")
+    parser.add_argument("--legacy-xo",action='store_true',help="""Use the old model of 1 or 2 crossovers at least 40Mb apart instead of the interference model""")
+    parser.add_argument("-o",type=str,default='sim_output.txt',help="""Name of the outfile (Default: sim_output.txt)""")
+    parser.add_argument("--format",type=str,default='txt',help="""Format of the outfile. Options are 'txt', 'gzip', 'bgzf' or 'columns' (a directory of binary columns) (Default: txt)""")
+    parser.add_argument("--chunk",type=int,default=10000,help="""Number of lines simulated per task (Default: 10000). Changing it changes the output for a given seed. Intercross generations only mate lines of the same chunk""")
     args = parser.parse_args()
     return args
 
 
-def chrom_info(chro_num,cent):
+DATA_DIR=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','data_files')
+
+
+def chrom_info(chro_num,cent=None):
     """chro_num: chromosome number (int)
+    cent: (pandas df) B73v4centromeres.txt table (Default: read from data_files/)
     Outputs:
+    xo_prob: (np.array) probability of a crossover in each 1Mb block
     end: (int) the approximate end of the chromosome, in Mb
     """
-    #cent = pd.read_table('data_files/B73v4centromeres.txt',sep='\t')
+    if cent is None:
+        cent = read_centromeres()
     cdf = cent[cent['chr']==chro_num]
     end = int(cdf['v4chr.end'].values[0])
     centstart = int(cdf['v4start'].values[0])
@@ -32,18 +53,127 @@ def chrom_info(chro_num,cent):
     else:
         longarm = centstart
         shortarm = end-centend
-    diff = longarm-shortarm
-    a = [i**2 for i in list(reversed(range(0,centstart+1)))]
-    c = [0.0 for i in range(centlen)]
-    b = [i**2 for i in range(longarm)]
-    xo_prob = a+c+b
-    if len(xo_prob)>= end:
-        xo_prob=xo_prob[:end]
-    xo_prob = [float(j)/sum(xo_prob) for j in xo_prob]
-    return xo_prob,end
+    a = np.arange(centstart,-1,-1,dtype=float)**2
+    c = np.zeros(centlen)
+    b = np.arange(longarm,dtype=float)**2
+    xo_prob = np.concatenate((a,c,b))[:end]
+    return xo_prob/xo_prob.sum(),end
+
+
+def read_centromeres(infile=None):
+    """Reads B73v4centromeres.txt (Default: the copy in data_files/)"""
+    if infile is None:
+        infile = os.path.join(DATA_DIR,'B73v4centromeres.txt')
+    return pd.read_table(infile,sep='\t')
+
+
+# Genetic length (Morgans) used when a map has none: the mean number of crossovers
+# per meiosis of the 1 or 2 crossover model in draw_crossovers()
+DEFAULT_LENGTH=1.4
+
+
+class RecombinationMap(object):
+    """Cumulative distribution of crossover positions along one chromosome.
+
+    The map is stored as knot positions (bp) and the cumulative probability
+    at each knot, with probability spread uniformly between knots. Breakpoints
+    are drawn by inverse-CDF sampling: a binary search finds the interval a
+    uniform draw falls in and the position is interpolated within it, so draws
+    are at base-pair resolution whatever the spacing of the knots.
+    """
+
+    def __init__(self,chrom,pos,weight,length=None):
+        """chrom: (int) chromosome number
+        pos: (array) increasing knot positions in bp, length k+1
+        weight: (array) relative crossover probability of each of the k intervals
+        length: (float) genetic length of the chromosome in Morgans, the mean number of
+        crossovers per meiosis (Default: DEFAULT_LENGTH)
+        """
+        weight=np.clip(np.asarray(weight,dtype=float),0,None)
+        self.chrom=chrom
+        self.pos=np.asarray(pos,dtype=float)
+        self.cdf=np.concatenate(([0.0],np.cumsum(weight)))
+        self.cdf/=self.cdf[-1]
+        self.end=int(self.pos[-1])
+        self.length=DEFAULT_LENGTH if length is None else length
 
+    @classmethod
+    def from_centromeres(cls,chrom,cent=None):
+        """Builds the map from the centromere-distance model of chrom_info() at 1Mb knots"""
+        xo_prob,end=chrom_info(chrom,cent)
+        pos=np.arange(len(xo_prob)+1)*1e6
+        return cls(chrom,pos,xo_prob)
 
-def chrom_sim(founders,pnum,cent,c=10):
+    @classmethod
+    def from_recomb_prob(cls,chrom,table):
+        """Builds the map from a table with columns pos and xo_prob (i.e. data_files/recomb_prob_est.csv),
+        where xo_prob is the crossover probability of the interval starting at pos"""
+        table=table.sort_values('pos')
+        pos=table['pos'].values
+        pos=np.append(pos,pos[-1]+(pos[-1]-pos[-2]))
+        return cls(chrom,pos,table['xo_prob'].values)
+
+    @classmethod
+    def from_ogut(cls,chrom,ogutmap):
+        """Builds the map from a genetic map table with columns chr, pos and cM (i.e. data_files/ogut_map.csv).
+        Crossover probability of each interval is proportional to its genetic length"""
+        cmap=ogutmap[ogutmap['chr']==chrom].sort_values('pos')
+        if len(cmap) == 0:
+            raise ValueError("Chromosome {0} is not in the genetic map".format(chrom))
+        pos=np.concatenate(([0],cmap['pos'].values))
+        cM=cmap['cM'].values
+        weight=np.clip(np.concatenate(([0],np.diff(cM))),0,None)
+        return cls(chrom,pos,weight,length=weight.sum()/100)
+
+    def sample(self,u):
+        """Converts uniform draws u in [0,1) to crossover positions (bp)"""
+        i=np.searchsorted(self.cdf,u,side='right')-1
+        i=np.clip(i,0,len(self.cdf)-2)
+        frac=(u-self.cdf[i])/(self.cdf[i+1]-self.cdf[i])
+        return (self.pos[i]+frac*(self.pos[i+1]-self.pos[i])).astype(np.int64)
+
+    def draw(self,size,rng=np.random):
+        """Draws crossover positions (bp) with the given output shape"""
+        return self.sample(rng.random(size))
+
+    def block_prior(self,step=1e6):
+        """Crossover probability per block of step bp, for use with the block-based functions
+        Returns: prior (np.array), end (int) number of blocks"""
+        edges=np.arange(0,self.end+step,step)
+        prior=np.diff(np.interp(np.minimum(edges,self.end),self.pos,self.cdf))
+        return prior,len(prior)
+
+
+MAP_SOURCES={'centromere':'B73v4centromeres.txt','recomb':'recomb_prob_est.csv','ogut':'ogut_map.csv'}
+_recomb_maps={}
+
+
+def recomb_map(c=10,source='centromere',infile=None):
+    """Returns the RecombinationMap for chromosome c, building it only on the first call
+    Input:
+    c: chromosome number (Default: 10)
+    source: (str) 'centromere', 'recomb' or 'ogut' (Default: 'centromere')
+    infile: (str) path to the source table (Default: the matching file in data_files/)
+    """
+    if source not in MAP_SOURCES:
+        raise ValueError("{0} is not a valid map source. Please choose from {1}".format(source,', '.join(MAP_SOURCES)))
+    if infile is None:
+        infile=os.path.join(DATA_DIR,MAP_SOURCES[source])
+    key=(c,source,infile)
+    if key not in _recomb_maps:
+        if source == 'centromere':
+            rmap=RecombinationMap.from_centromeres(c,read_centromeres(infile))
+        elif source == 'recomb':
+            if c != 10:
+                raise ValueError("recomb_prob_est.csv only covers chromosome 10")
+            rmap=RecombinationMap.from_recomb_prob(c,pd.read_csv(infile))
+        else:
+            rmap=RecombinationMap.from_ogut(c,pd.read_csv(infile))
+        _recomb_maps[key]=rmap
+    return _recomb_maps[key]
+
+
+def chrom_sim(founders,pnum,c=10):
     """
     pnum: (int) Number of parents to start with. Parents are randomly selected
     from the 26 NAM founders
@@ -55,8 +185,8 @@ def chrom_sim(founders,pnum,cent,c=10):
         parents=founders
     else:
         parents = np.random.choice(founders,pnum,replace=False)
+    prior,end=recomb_map(c).block_prior()
     for i in parents:
-        xo_prob,end=chrom_info(c)
         p = []
         for j in range(end+1):
             p.append(i)
@@ -78,9 +208,9 @@ def crossover(n,parents,c=10):
     If n>1, 2-D list of f1s
     """
     rils = []
+    prior,end=recomb_map(c).block_prior()
+    site = [s for s in range(end)]
     for i in range(n):
-        prior,end=chrom_info(c)
-        site = [s for s in range(end)]
         f1=[]
         #randomly choose a parent to start with
         if np.random.random_sample() >= 0.5:
@@ -123,48 +253,631 @@ def make_magic(parents,c=10,n=1):
     2-D list of length(n), simulated chromosomes
     """
     if len(parents)==2:
-        return crossover(n,parents)
+        return crossover(n,parents,c)
     rounds = []
     for i in range(0,len(parents),2):
-        rounds.append(crossover(n,parents[i:i+2]))
-    return make_magic(rounds)
+        rounds.append(crossover(n,parents[i:i+2],c))
+    return make_magic(rounds,c)
+
+
+def founder_codes(founders):
+    """Assigns a small integer code to each founder
+    Input:
+    founders: (list) founder names
+
+    Output:
+    codes: (np.array) integer codes, int8 when there are fewer than 128 founders
+    names: (np.array) lookup table of founder names, where names[code] is the founder
+    """
+    names=np.array(founders)
+    dtype = np.int8 if len(names) < 128 else np.int16
+    codes=np.arange(len(names),dtype=dtype)
+    return codes,names
+
+
+def chrom_array(codes,end):
+    """Batched version of chrom_sim(). Builds a 2-D array of shape (len(codes),end+1)
+    where row i holds founder code codes[i] in every 1Mb block"""
+    codes=np.asarray(codes)
+    return np.repeat(codes[:,None],end+1,axis=1)
+
+
+def draw_crossovers(n,rmap,rng=np.random,min_dist=40e6):
+    """Draws the crossover positions for n meioses at once
+    Input:
+    n: (int) number of meioses
+    rmap: (RecombinationMap) map of the chromosome, output of recomb_map()
+    rng: random number generator (Default: the global np.random state)
+    min_dist: minimum distance between two crossovers in one meiosis (Default: 40Mb)
+
+    Output:
+    2-D int array of shape (n,2) of sorted crossover positions. Meioses with a single
+    crossover have their second position set past the end of the chromosome
+    """
+    xo=rng.choice([1,2],size=n,p=[0.6,0.4])
+    draw=rmap.draw((n,2),rng)
+    redo=(xo==2) & (np.abs(draw[:,1]-draw[:,0]) < min_dist)
+    while redo.any():
+        draw[redo,1]=rmap.draw(redo.sum(),rng)
+        redo=(xo==2) & (np.abs(draw[:,1]-draw[:,0]) < min_dist)
+    draw[xo==1,1]=np.iinfo(draw.dtype).max
+    draw.sort(axis=1)
+    return draw
+
+
+def stahl_crossovers(n,rmap,rng=np.random,m=4,p=0.0):
+    """Draws the crossover positions for n meioses at once under the chi-square model of
+    crossover interference, with the Housworth-Stahl escape pathway when p > 0. There are
+    no rejection loops, so the cost per meiosis is fixed by the map length
+    On the genetic map, the interfering chiasmata are every (m+1)th point of a Poisson
+    process with rate 2*(m+1)*(1-p) per Morgan, starting from a random one of the first m+1
+    points, and each chiasma ends up in the gamete with probability 1/2. A further
+    fraction p of crossovers escape interference and are a Poisson process with rate p.
+    Genetic positions are converted to bp through the map's inverse CDF
+    Input:
+    n: (int) number of meioses
+    rmap: (RecombinationMap) map of the chromosome, output of recomb_map()
+    rng: random number generator (Default: the global np.random state)
+    m: (int) interference parameter, 0 for no interference (Default: 4)
+    p: (float) proportion of crossovers that escape interference (Default: 0)
+
+    Output:
+    2-D int array of shape (n,k) of sorted crossover positions, where k is the largest
+    number of crossovers in any meiosis. Unused positions are set past the end of the chromosome
+    """
+    L=rmap.length
+    #Interfering pathway
+    counts=rng.poisson(2*(m+1)*(1-p)*L,n)
+    line=np.repeat(np.arange(n),counts)
+    pos=rng.random(len(line))
+    order=np.lexsort((pos,line))
+    idx=np.arange(len(line))-np.repeat(np.cumsum(counts)-counts,counts)
+    phase=rng.integers(0,m+1,n) if hasattr(rng,'integers') else rng.randint(0,m+1,n)
+    keep=(idx % (m+1) == phase[line]) & (rng.random(len(line)) < 0.5)
+    xline,xpos=line[keep],pos[order][keep]
+    #Non-interfering pathway
+    if p > 0:
+        counts=rng.poisson(p*L,n)
+        xline=np.concatenate((xline,np.repeat(np.arange(n),counts)))
+        xpos=np.concatenate((xpos,rng.random(counts.sum())))
+    order=np.lexsort((xpos,xline))
+    xline,xpos=xline[order],xpos[order]
+    counts=np.bincount(xline,minlength=n)
+    draw=np.full((n,max(counts.max() if n else 0,1)),np.iinfo(np.int64).max,dtype=np.int64)
+    draw[xline,np.arange(len(xline))-np.repeat(np.cumsum(counts)-counts,counts)]=rmap.sample(xpos)
+    return draw
+
+
+def draw_breakpoints(n,prior,rng=np.random):
+    """Draws the crossover blocks for n meioses at once
+    Input:
+    n: (int) number of meioses
+    prior: (list or np.array) probability of a crossover in each 1Mb block, output of chrom_info() or RecombinationMap.block_prior()
+    rng: random number generator (Default: the global np.random state)
+
+    Output:
+    2-D int array of shape (n,2) of sorted breakpoint blocks. Meioses with a single
+    crossover have their second breakpoint set past the end of the chromosome
+    """
+    blockmap=RecombinationMap(None,np.arange(len(prior)+1),prior)
+    return draw_crossovers(n,blockmap,rng,min_dist=40)
+
+
+def batch_crossover(n,p1,p2,prior,rng=np.random):
+    """ Vectorized version of crossover(). Simulates n meioses between two parents
+    in a single array operation
+    Input:
+    n: (int) number of f1 samples to produce
+    p1,p2: (np.array) parent chromosomes of founder codes, either 1-D of length
+    blocks (the same parent for every f1) or 2-D of shape (n,blocks)
+    prior: crossover probability per block, output of chrom_info() or RecombinationMap.block_prior()
+
+    Output:
+    2-D array of shape (n,blocks) of founder codes
+    """
+    blocks=np.shape(p1)[-1]
+    draw=draw_breakpoints(n,prior,rng)
+    site=np.arange(blocks)
+    switches=(site >= draw[:,:1]).astype(np.int8) + (site >= draw[:,1:])
+    #randomly choose a parent to start with
+    first=(rng.random(n) < 0.5)[:,None]
+    return np.where((switches % 2 == 1) ^ first,p2,p1)
+
+
+def batch_magic(parents,n,prior,rng=np.random):
+    """ Vectorized version of make_magic(). Every cross in the funnel produces
+    one f1 per line, and all n lines are simulated together at each round
+    Input:
+    parents: 2-D array of parent chromosomes, output of chrom_array() (length must be a power of 2)
+    n: (int) number of MAGIC lines to make
+    prior: crossover probability per block, output of chrom_info() or RecombinationMap.block_prior()
+
+    Output:
+    2-D array of shape (n,blocks) of founder codes
+    """
+    rounds=list(parents)
+    while len(rounds) > 1:
+        rounds=[batch_crossover(n,rounds[i],rounds[i+1],prior,rng) for i in range(0,len(rounds),2)]
+    return rounds[0]
+
+
+class SparseChrom(object):
+    """A batch of simulated chromosomes stored as breakpoints and donors, the same
+    representation RIL_Simulator.R uses.
+
+    Line i has segments offsets[i]..offsets[i+1]-1. Segment j covers the positions
+    after the previous segment's end up to and including ends[j] (bp) and was received
+    from founder code donors[j]. The last end of every line is the chromosome end, so
+    memory grows with the number of crossovers and not with map resolution.
+    """
+
+    def __init__(self,ends,donors,offsets,c=10):
+        self.ends=np.asarray(ends,dtype=np.int64)
+        self.donors=np.asarray(donors)
+        self.offsets=np.asarray(offsets,dtype=np.int64)
+        self.c=c
+
+    @classmethod
+    def founders(cls,codes,end,c=10):
+        """Builds one unrecombined chromosome per founder code, ending at end (bp)"""
+        codes=np.asarray(codes)
+        return cls(np.full(len(codes),end),codes,np.arange(len(codes)+1),c)
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def line(self,i):
+        """Returns the (ends,donors) arrays of line i"""
+        a,b=self.offsets[i],self.offsets[i+1]
+        return self.ends[a:b],self.donors[a:b]
+
+    def take(self,idx):
+        """Returns a new SparseChrom with the lines in idx (repeats allowed)"""
+        idx=np.asarray(idx,dtype=np.int64)
+        counts=self.offsets[idx+1]-self.offsets[idx]
+        offsets=np.concatenate(([0],np.cumsum(counts)))
+        seg=np.repeat(self.offsets[idx]-offsets[:-1],counts)+np.arange(offsets[-1])
+        return SparseChrom(self.ends[seg],self.donors[seg],offsets,self.c)
+
+    def locations(self,i):
+        """Returns line i in the format of locations(): [[chr,start,end,donor],...]"""
+        ends,donors=self.line(i)
+        starts=np.concatenate(([0],ends[:-1]+1))
+        return [[self.c,s,e,d] for s,e,d in zip(starts,ends,donors)]
+
+    @classmethod
+    def concat(cls,chunks):
+        """Joins SparseChrom batches of the same chromosome into one, in order"""
+        counts=np.concatenate([np.diff(sc.offsets) for sc in chunks])
+        return cls(np.concatenate([sc.ends for sc in chunks]),
+                   np.concatenate([sc.donors for sc in chunks]),
+                   np.concatenate(([0],np.cumsum(counts))),chunks[0].c)
+
+    def starts(self):
+        """Start position (bp) of every segment"""
+        starts=np.append(0,self.ends[:-1]+1)
+        starts[self.offsets[:-1][np.diff(self.offsets) > 0]]=0
+        return starts
+
+    def line_index(self):
+        """Line number of every segment"""
+        return np.repeat(np.arange(len(self)),np.diff(self.offsets))
+
+
+def sparse_crossover(p1,p2,xo,rng=np.random):
+    """ Sparse version of batch_crossover(). Simulates n meioses between two batches of
+    parents. Cost is proportional to the number of segments in the parents plus the
+    number of crossovers, whatever the resolution of the map
+    Input:
+    p1,p2: (SparseChrom) parent chromosomes, either 1 line (the same parent for every f1)
+    or n lines (line i is crossed with line i)
+    xo: 2-D int array of shape (n,k) of sorted crossover positions, output of draw_crossovers().
+    Positions past the end of the chromosome are ignored
+
+    Output:
+    SparseChrom of n lines
+    """
+    n=len(xo)
+    if len(p1) == 1:
+        p1=p1.take(np.zeros(n,dtype=np.int64))
+    if len(p2) == 1:
+        p2=p2.take(np.zeros(n,dtype=np.int64))
+    end=p1.ends[p1.offsets[1]-1]
+    #Key every position by its line so one sorted search covers all lines at once
+    width=np.int64(end)+1
+    key1=p1.line_index()*width+p1.ends
+    key2=p2.line_index()*width+p2.ends
+    xline,xcol=np.nonzero(xo < end)
+    xkey=xline*width+xo[xline,xcol]
+    keys=np.sort(np.concatenate((key1,key2,xkey)))
+    keys=keys[np.append(True,keys[1:] != keys[:-1])]
+    line=keys//width
+    #A base is on the second parent after an odd number of crossovers before it
+    nxo=np.searchsorted(xkey,keys,side='left')-np.searchsorted(xkey,line*width,side='left')
+    #randomly choose a parent to start with
+    first=rng.random(n) < 0.5
+    second=(nxo % 2 == 1) ^ first[line]
+    donors=np.where(second,
+                    p2.donors[np.minimum(np.searchsorted(key2,keys,side='left'),len(key2)-1)],
+                    p1.donors[np.minimum(np.searchsorted(key1,keys,side='left'),len(key1)-1)])
+    #Merge neighbouring segments from the same donor
+    keep=np.ones(len(keys),dtype=bool)
+    keep[:-1]=(donors[:-1] != donors[1:]) | (line[:-1] != line[1:])
+    offsets=np.concatenate(([0],np.cumsum(np.bincount(line[keep],minlength=n))))
+    return SparseChrom(keys[keep]-line[keep]*width,donors[keep],offsets,p1.c)
+
+
+def sparse_magic(codes,n,rmap,rng=np.random):
+    """ Sparse version of make_magic(). Every cross in the funnel produces one f1 per
+    line, and all n lines are simulated together at each round
+    Input:
+    codes: founder codes, output of founder_codes() (length must be a power of 2)
+    n: (int) number of MAGIC lines to make
+    rmap: (RecombinationMap) map of the chromosome, output of recomb_map()
+
+    Output:
+    SparseChrom of n lines
+    """
+    rounds=[SparseChrom.founders([f],rmap.end,rmap.chrom) for f in codes]
+    while len(rounds) > 1:
+        rounds=[sparse_crossover(rounds[i],rounds[i+1],draw_crossovers(n,rmap,rng),rng) for i in range(0,len(rounds),2)]
+    return rounds[0]
+
+
+def align_haplotypes(h1,h2):
+    """Splits the two haplotypes of a batch of diploid lines at the union of their
+    breakpoints, so donor1 and donor2 can be reported segment by segment
+    Input:
+    h1,h2: (SparseChrom) the two haplotypes, with the same number of lines
+
+    Output:
+    (SparseChrom,SparseChrom) with identical ends and offsets, merging neighbouring
+    segments where both donors are unchanged
+    """
+    if h1 is h2:
+        return h1,h2
+    n=len(h1)
+    width=np.int64(h1.ends[h1.offsets[1]-1])+1
+    key1=h1.line_index()*width+h1.ends
+    key2=h2.line_index()*width+h2.ends
+    keys=np.sort(np.concatenate((key1,key2)))
+    keys=keys[np.append(True,keys[1:] != keys[:-1])]
+    line=keys//width
+    donor1=h1.donors[np.searchsorted(key1,keys,side='left')]
+    donor2=h2.donors[np.searchsorted(key2,keys,side='left')]
+    keep=np.ones(len(keys),dtype=bool)
+    keep[:-1]=(donor1[:-1] != donor1[1:]) | (donor2[:-1] != donor2[1:]) | (line[:-1] != line[1:])
+    offsets=np.concatenate(([0],np.cumsum(np.bincount(line[keep],minlength=n))))
+    ends=keys[keep]-line[keep]*width
+    return SparseChrom(ends,donor1[keep],offsets,h1.c),SparseChrom(ends,donor2[keep],offsets,h1.c)
+
+
+def make_gametes(ind,rmap,rng=np.random,interference=(4,0.0)):
+    """Draws one gamete from each diploid individual in a batch
+    Input:
+    ind: (tuple) (h1,h2) SparseChrom haplotypes of the individuals
+    interference: (tuple) (m,p) parameters of stahl_crossovers(), or None for the
+    1 or 2 crossover model of draw_crossovers() (Default: (4,0.0))
+
+    Output:
+    SparseChrom with one haploid chromosome per individual
+    """
+    h1,h2=ind
+    if interference is None:
+        xo=draw_crossovers(len(h1),rmap,rng)
+    else:
+        xo=stahl_crossovers(len(h1),rmap,rng,*interference)
+    return sparse_crossover(h1,h2,xo,rng)
+
+
+DESIGNS={'magic':'funnel,dh','ril':'funnel,self:6'}
+DESIGN_STEPS=('funnel','intercross','self','dh')
+
+
+def parse_design(design):
+    """Parses a breeding design into a list of (step,generations)
+    Input:
+    design: (str) comma separated steps, applied in order, or a name in DESIGNS
+    ('magic' or 'ril'). Steps are:
+        funnel: cross the founders in pairs, in the order given, until every line descends from all of them
+        intercross:k: k generations of random mating between lines, never of a line with itself.
+        genome_sim_chunks() mates lines only within each chunk, so the pedigree depends on the chunk size
+        self:k: k generations of selfing
+        dh: doubled haploid from one gamete of each line
+    i.e. 'funnel,intercross:2,self:6' or 'funnel,dh'
+    """
+    design=DESIGNS.get(design,design)
+    steps=[]
+    for step in design.split(','):
+        name,k=(step.split(':')+['1'])[:2]
+        if name not in DESIGN_STEPS:
+            raise ValueError("{0} is not a valid design step. Please choose from {1}".format(name,', '.join(DESIGN_STEPS)))
+        steps.append((name,int(k)))
+    if steps[0][0] != 'funnel':
+        raise ValueError("A design must start with 'funnel'")
+    return steps
+
+
+def run_design(codes,n,design,rmap,rng=np.random,ped_rng=None,interference=(4,0.0)):
+    """Simulates n lines of a multi-generation breeding design. Each generation is one
+    batched operation across all lines (and all crosses of a funnel round)
+    Input:
+    codes: founder codes, output of founder_codes(). For the funnel, the number of
+    founders must be a power of 2, i.e. 8 or 16 for MAGIC, 2 for a biparental cross
+    n: (int) number of lines
+    design: (str or list) breeding design, see parse_design()
+    rmap: (RecombinationMap) map of the chromosome, output of recomb_map()
+    rng: random number generator for meioses
+    ped_rng: random number generator for the pedigree (intercross mates). Must be seeded
+    the same way for every chromosome of a line so they share one pedigree (Default: rng)
+    interference: crossover model, see make_gametes() (Default: (4,0.0))
+
+    Output:
+    (h1,h2) tuple of SparseChrom, the two haplotypes of the n lines
+    """
+    if ped_rng is None:
+        ped_rng=rng
+    steps=parse_design(design) if isinstance(design,str) else design
+    m=len(codes)
+    if m < 2 or m & (m-1):
+        raise ValueError("The number of founders in a funnel must be a power of 2, not {0}".format(m))
+    #Individuals are stored j*n+i for cross j of line i. The founder pairs make the f1s
+    founders=SparseChrom.founders(codes,rmap.end,rmap.chrom)
+    j=np.repeat(np.arange(0,m,2),n)
+    ind=(founders.take(j),founders.take(j+1))
+    m//=2
+    for name,k in steps:
+        for g in range(k):
+            if name == 'funnel':
+                while m > 1:
+                    gam=make_gametes(ind,rmap,rng,interference)
+                    idx=np.arange(m*n).reshape(m,n)
+                    ind=(gam.take(idx[0::2].ravel()),gam.take(idx[1::2].ravel()))
+                    m//=2
+            elif name == 'intercross':
+                if n < 2:
+                    raise ValueError("An intercross needs at least 2 lines, not {0}".format(n))
+                #Lines are mated around a random cycle, so no line is mated with itself
+                order=ped_rng.permutation(n)
+                mates=np.empty(n,dtype=np.int64)
+                mates[order]=np.roll(order,-1)
+                ind=(make_gametes(ind,rmap,rng,interference),make_gametes((ind[0].take(mates),ind[1].take(mates)),rmap,rng,interference))
+            elif name == 'self':
+                ind=(make_gametes(ind,rmap,rng,interference),make_gametes(ind,rmap,rng,interference))
+            else:
+                gam=make_gametes(ind,rmap,rng,interference)
+                ind=(gam,gam)
+    return ind
+
+
+def task_rng(seed,c,k):
+    """Independent random number generator for chunk k of chromosome c. The stream
+    depends only on the master seed and (c,k), not on which worker runs it"""
+    return np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed,spawn_key=(c,k))))
+
+
+def pedigree_rng(seed,k):
+    """Random number generator for the pedigree of chunk k, shared by all chromosomes"""
+    return np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed,spawn_key=(k,))))
+
+
+def sim_task(task):
+    """Simulates one chunk of lines for one chromosome
+    Input:
+    task: (tuple) (codes,n,c,k,design,map source,seed,interference)
+
+    Output:
+    (h1,h2) tuple of SparseChrom for n lines, output of run_design()
+    """
+    codes,n,c,k,design,source,seed,interference=task
+    return run_design(codes,n,design,recomb_map(c,source),task_rng(seed,c,k),pedigree_rng(seed,k),interference)
+
+
+def bounded_imap(pool,func,tasks,window):
+    """Yields func(task) for each task in order, computed in pool with at most window tasks
+    submitted at a time, so finished chunks that have not been consumed yet do not pile up in
+    memory. A new task is submitted as each result is yielded"""
+    tasks=iter(tasks)
+    pending=deque(pool.apply_async(func,(t,)) for t in islice(tasks,window))
+    while pending:
+        result=pending.popleft().get()
+        for t in islice(tasks,1):
+            pending.append(pool.apply_async(func,(t,)))
+        yield result
+
+
+def genome_sim_chunks(codes,n,chroms=range(1,11),design='magic',source='centromere',seed=None,workers=1,chunk=10000,interference=(4,0.0)):
+    """Simulates n lines for every chromosome in chroms across a pool of worker processes.
+    Lines are split into chunks of chunk lines and every (chromosome,chunk) task draws from
+    its own random stream derived from seed, so the result is identical whatever the
+    number of workers, but not whatever the chunk size: intercross generations only mate
+    lines of the same chunk. A last chunk of a single line is merged into the one before for
+    designs with an intercross. At most 2*workers tasks are in flight at a time
+    Input:
+    codes: founder codes, output of founder_codes()
+    n: (int) number of lines
+    chroms: chromosome numbers (Default: 1..10)
+    design: (str) breeding design, see parse_design() (Default: 'magic')
+    source: (str) recombination map source, see recomb_map() (Default: 'centromere')
+    seed: (int) master seed (Default: None, fresh entropy)
+    workers: (int) number of worker processes (Default: 1)
+    chunk: (int) lines per task (Default: 10000)
+    interference: crossover model, see make_gametes() (Default: (4,0.0))
+
+    Output:
+    Yields, for each chunk of lines in order, a list with one (h1,h2) tuple of SparseChrom
+    per chromosome in chroms
+    """
+    if seed is None:
+        seed=np.random.SeedSequence().entropy
+    chroms=list(chroms)
+    sizes=[min(chunk,n-start) for start in range(0,n,chunk)]
+    steps=parse_design(design)
+    #A chunk of one line has no mate for an intercross
+    if len(sizes) > 1 and sizes[-1] == 1 and any(name == 'intercross' for name,k in steps):
+        sizes[-2:]=[sizes[-2]+1]
+    tasks=[(codes,size,c,k,design,source,seed,interference) for k,size in enumerate(sizes) for c in chroms]
+    if workers > 1:
+        pool=Pool(workers)
+        results=bounded_imap(pool,sim_task,tasks,2*workers)
+    else:
+        pool=None
+        results=(sim_task(t) for t in tasks)
+    try:
+        for k in range(len(sizes)):
+            yield [next(results) for c in chroms]
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def genome_sim(codes,n,chroms=range(1,11),design='magic',source='centromere',seed=None,workers=1,chunk=10000,interference=(4,0.0)):
+    """Simulates n lines for every chromosome in chroms, see genome_sim_chunks()
+    Output:
+    list of (h1,h2) tuples of SparseChrom, one per chromosome in chroms
+    """
+    chunks=list(genome_sim_chunks(codes,n,chroms,design,source,seed,workers,chunk,interference))
+    pop=[]
+    for i in range(len(chunks[0])):
+        h1=SparseChrom.concat([k[i][0] for k in chunks])
+        if all(k[i][0] is k[i][1] for k in chunks):
+            h2=h1
+        else:
+            h2=SparseChrom.concat([k[i][1] for k in chunks])
+        pop.append((h1,h2))
+    return pop
 
 
 def locations(r,c=10):
     """Identifies chromosome breakpoints and returns a list of format:
     [[chr,start,end,donor],...]
-    Input: (list) simulated chromosome (i.e. f[0])
-    """
-    locs=[]
-    last = r[0]
-    counter = 0
-    for i in range(len(r)):
-        if r[i] != last:
-            start = i
-            locs.append([c,counter*1e6,(start*1e6)-1,last])
-            counter=start
-            last = r[i]
-    locs.append([c,start*1e6,len(r)*1e6,last])
-    return locs
-
-
-def make_outfile(ril,out):
+    Input: (list or np.array) simulated chromosome (i.e. f[0])
+    """
+    r=np.asarray(r)
+    starts=np.concatenate(([0],np.flatnonzero(r[1:] != r[:-1])+1))
+    ends=np.append(starts[1:]*1e6-1,len(r)*1e6)
+    return [[c,s*1e6,e,r[s]] for s,e in zip(starts,ends)]
+
+
+def make_outfile(ril,out,names=None):
     """ Writes out file in format: 
+    ril: simulated lines, either a list of chromosomes, a SparseChrom, an (h1,h2) tuple
+    of SparseChrom, or a list of these with one per chromosome (output of genome_sim())
     out: name of outfile (str)
+    names: (np.array) founder lookup table from founder_codes(), if ril holds founder codes
     """
-    txt = 'sample\tchr\tstart\tend\tdonor1\tdonor2\n'
-    count=1
-    for j in ril:
-        locs = locations(j)
-        for l in locs:
-            txt+='{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n'.format('M'+str(count),l[0],int(l[1]),int(l[2]),l[3],l[3])
-        count+=1
+    #An empty population falls through to the list writer, which writes only the header
+    if isinstance(ril,SparseChrom) or (len(ril) > 0 and (isinstance(ril,tuple) or isinstance(ril[0],(SparseChrom,tuple)))):
+        with SimWriter(out,names) as writer:
+            writer.write(ril)
+        return
     with open(out,'w') as outfile:
-        outfile.write(txt)
+        outfile.write('sample\tchr\tstart\tend\tdonor1\tdonor2\n')
+        for count,j in enumerate(ril,1):
+            for l in locations(j):
+                donor = l[3] if names is None else names[l[3]]
+                outfile.write('{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n'.format('M'+str(count),l[0],int(l[1]),int(l[2]),donor,donor))
+
+
+OUT_FORMATS=('txt','gzip','bgzf','columns')
+COLUMN_DTYPES=[('sample','<u4'),('chr','<u1'),('start','<i8'),('end','<i8'),('donor1','<i2'),('donor2','<i2')]
+
+
+class SimWriter(object):
+    """Streams simulated lines to an outfile as they are generated, in constant memory.
+
+    Formats:
+    txt: the tab-delimited make_outfile() table
+    gzip: the same table, gzip compressed
+    bgzf: the same table, BGZF compressed (readable by zcat, bgzip and tabix)
+    columns: a directory holding one raw little-endian binary file per column
+    (sample number, chr, start, end, donor codes) plus founders.txt, see read_columns()
+    """
+
+    def __init__(self,out,names=None,fmt='txt'):
+        if fmt not in OUT_FORMATS:
+            raise ValueError("{0} is not a valid output format. Please choose from {1}".format(fmt,', '.join(OUT_FORMATS)))
+        self.fmt=fmt
+        self.names=names
+        self.count=0
+        if fmt == 'columns':
+            if not os.path.isdir(out):
+                os.makedirs(out)
+            self.handles=[open(os.path.join(out,col+'.bin'),'wb') for col,dtype in COLUMN_DTYPES]
+            with open(os.path.join(out,'founders.txt'),'w') as ffile:
+                if names is not None:
+                    ffile.write(''.join('{0}\n'.format(f) for f in names))
+            return
+        if fmt == 'gzip':
+            self.handle=gzip.open(out,'wb')
+        elif fmt == 'bgzf':
+            self.handle=BgzfWriter(out)
+        else:
+            self.handle=open(out,'wb')
+        self.handle.write(b'sample\tchr\tstart\tend\tdonor1\tdonor2\n')
+
+    def write(self,lines):
+        """Appends a batch of lines, numbered after the lines already written
+        Input:
+        lines: SparseChrom or (h1,h2) tuple of SparseChrom, or a list of these with one
+        per chromosome
+        """
+        if isinstance(lines,(SparseChrom,tuple)):
+            lines=[lines]
+        lines=[align_haplotypes(*sc) if isinstance(sc,tuple) else (sc,sc) for sc in lines]
+        #One row per segment, ordered by line and then by chromosome
+        sample=np.concatenate([sc.line_index() for sc,sc2 in lines])
+        order=np.argsort(sample,kind='stable')
+        sample=sample[order]+self.count+1
+        chrom=np.concatenate([np.full(len(sc.ends),sc.c) for sc,sc2 in lines])[order]
+        end=np.concatenate([sc.ends for sc,sc2 in lines])[order]
+        start=np.concatenate([sc.starts() for sc,sc2 in lines])[order]
+        donor1=np.concatenate([sc.donors for sc,sc2 in lines])[order]
+        donor2=np.concatenate([sc2.donors for sc,sc2 in lines])[order]
+        self.count+=len(lines[0][0])
+        if self.fmt == 'columns':
+            for handle,col,(name,dtype) in zip(self.handles,(sample,chrom,start,end,donor1,donor2),COLUMN_DTYPES):
+                handle.write(col.astype(dtype).tobytes())
+            return
+        if self.names is not None:
+            donor1=self.names[donor1]
+            donor2=self.names[donor2]
+        cols=[col.tolist() for col in (sample,chrom,start,end,donor1,donor2)]
+        rows=''.join(['M%s\t%s\t%s\t%s\t%s\t%s\n' % r for r in zip(*cols)])
+        self.handle.write(rows.encode())
+
+    def close(self):
+        if self.fmt == 'columns':
+            for handle in self.handles:
+                handle.close()
+        else:
+            self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+
+def read_columns(path,mmap=True):
+    """Reads an outfile written by SimWriter in the 'columns' format
+    Returns: dict of column name to np.array (memory-mapped if mmap), and the founder names"""
+    cols={}
+    for col,dtype in COLUMN_DTYPES:
+        infile=os.path.join(path,col+'.bin')
+        if mmap and os.path.getsize(infile) > 0:
+            cols[col]=np.memmap(infile,dtype=dtype,mode='r')
+        else:
+            cols[col]=np.fromfile(infile,dtype=dtype)
+    with open(os.path.join(path,'founders.txt'),'r') as ffile:
+        names=np.array([line[:-1] for line in ffile])
+    return cols,names
 
 
 def parse_founders(infile):
-    if os.path.is_file(infile):
+    if os.path.isfile(infile):
         founders = []
         with open(infile,'r') as ffile:
             for line in ffile:
@@ -176,16 +889,11 @@ def parse_founders(infile):
 if __name__ == "__main__":
     args = arg_parse()
     founders = parse_founders(args.f)
-    if args.t == 'magic':
-        pop = chrom_sim(founders)
-        lines = [make_magic(pop) for i in range(args.n)]
-        make_outfile(lines,'sim_output.txt')
-    elif args.t == 'ril':
-        if len(founders) == 2:
-            pop=chrom_sim(founders)
-            lines = crossover(1,pop)
-            make_outfile(lines,'sim_output.txt')
-        else:
-            print("For line type option 'ril', number of founders must be 2")
-    else:
-        print("{0} is not a valid line type. Please choose 'magic' or 'ril'".format(args.t))
+    codes,names = founder_codes(founders)
+    chroms = range(1,11) if args.genome else args.c
+    seed = args.seed if args.seed is not None else np.random.SeedSequence().entropy
+    interference = None if args.legacy_xo else (int(args.interference[0]),args.interference[1])
+    print("Random seed: {0}".format(seed))
+    with SimWriter(args.o,names,args.format) as writer:
+        for lines in genome_sim_chunks(codes,args.n,chroms,args.t,args.m,seed,args.workers,args.chunk,interference):
+            writer.write(lines)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""
+Binary cache of the genotypes in a vcf file, so tools reading founder genotypes decode the
+vcf with bcftools once instead of on every run. The cache is a directory next to the vcf
+(<vcf>.gcache) holding:
+geno.bin: sites x samples x 2 int8 allele codes (-1 missing), memory-mapped when opened
+pos.npy, id.npy, ref.npy, alt.npy: site positions and fixed-width names, memory-mapped
+meta.json: samples, chromosome row ranges, array shape and the size, mtime and sha1 of the vcf
+It is rebuilt automatically when the vcf changes.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from io import BytesIO
+import numpy as np
+import pandas as pd
+import bcftools_exec
+
+CACHE_VERSION=1
+
+
+def get_args():
+    parser=argparse.ArgumentParser(description="""Program description: Converts a vcf file to the binary genotype cache read by build_simvcf.py and build_ril.py""")
+    parser.add_argument("vcf",type=str,help="""The input vcf file""")
+    parser.add_argument("--out",type=str,default=None,help="""Cache directory (Default: <vcf>.gcache)""")
+    parser.add_argument("--force",action='store_true',help="""Rebuild the cache even if it is up to date""")
+    args=parser.parse_args()
+    return args
+
+
+def decode_gt(gt):
+    """Converts an array of GT strings (0/1, 1|1, ./., 0, ...) to int8 allele codes with a
+    last axis of length 2, -1 for missing alleles. Haploid calls fill both alleles, and
+    other FORMAT fields after the GT (0/1:12,3:...) are ignored.
+    Each distinct string is parsed once, so this is fast on large arrays"""
+    gt=np.asarray(gt)
+    codes,uniques=pd.factorize(gt.ravel())
+    lookup=np.full((len(uniques)+1,2),-1,dtype=np.int8)
+    for i,u in enumerate(uniques):
+        alleles=str(u).split(':')[0].replace('|','/').split('/')
+        alleles=[-1 if a in ('.','') else int(a) for a in alleles]
+        lookup[i]=[alleles[0],alleles[-1]]
+    return lookup[codes].reshape(gt.shape+(2,))
+
+
+def file_hash(path,blocksize=1 << 20):
+    """sha1 of the contents of a file"""
+    h=hashlib.sha1()
+    with open(path,'rb') as infile:
+        for block in iter(lambda: infile.read(blocksize),b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def cache_path(vcf):
+    return vcf+'.gcache'
+
+
+def is_current(vcf,path):
+    """Whether the cache at path was built from the current contents of vcf. A vcf with a new
+    mtime but the same size is hashed, and the cache is kept if the contents did not change"""
+    meta_file=os.path.join(path,'meta.json')
+    if not os.path.isfile(meta_file):
+        return False
+    with open(meta_file) as infile:
+        meta=json.load(infile)
+    stat=os.stat(vcf)
+    if meta.get('version') != CACHE_VERSION or meta['size'] != stat.st_size:
+        return False
+    if meta['mtime_ns'] == stat.st_mtime_ns:
+        return True
+    if meta['sha1'] != file_hash(vcf):
+        return False
+    meta['mtime_ns']=stat.st_mtime_ns
+    with open(meta_file,'w') as outfile:
+        json.dump(meta,outfile)
+    return True
+
+
+def bcftools_samples(vcf):
+    stdout,stderr=bcftools_exec.run(['query','-l',vcf])
+    return stdout.decode().split()
+
+
+def line_chunks(lines,chunksize):
+    """Groups the bcftools output lines from bcftools_exec.lines() into pandas dfs of chunksize rows"""
+    buf=[]
+    for line in lines:
+        buf.append(line)
+        if len(buf) == chunksize:
+            yield pd.read_csv(BytesIO(b'\n'.join(buf)),sep='\t',header=None,dtype=str,keep_default_na=False)
+            buf=[]
+    if buf:
+        yield pd.read_csv(BytesIO(b'\n'.join(buf)),sep='\t',header=None,dtype=str,keep_default_na=False)
+
+
+def build_cache(vcf,path=None,chunksize=100000):
+    """Decodes vcf with one bcftools query and writes the cache, streaming chunksize sites at
+    a time so only the site names are held in memory. The cache is written to a temporary
+    directory and moved into place when complete
+    Returns: the cache directory"""
+    path=cache_path(vcf) if path is None else path
+    stat=os.stat(vcf)
+    sha1=file_hash(vcf)
+    samples=bcftools_samples(vcf)
+    tmp='{0}.{1}.tmp'.format(path,os.getpid())
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    chroms=[]
+    pos=[]
+    names={'id':[],'ref':[],'alt':[]}
+    lines=bcftools_exec.lines(['query','-f','%CHROM\t%POS\t%ID\t%REF\t%ALT[\t%GT]\n',vcf])
+    try:
+        with open(os.path.join(tmp,'geno.bin'),'wb') as outfile:
+            for chunk in line_chunks(lines,chunksize):
+                chroms.append(chunk[0].values)
+                pos.append(chunk[1].values.astype(np.int64))
+                for j,name in enumerate(['id','ref','alt'],2):
+                    names[name].append(chunk[j].values)
+                outfile.write(decode_gt(chunk.iloc[:,5:5+len(samples)].values).tobytes())
+    except bcftools_exec.BcftoolsError:
+        shutil.rmtree(tmp)
+        raise
+    chroms=np.concatenate(chroms) if chroms else np.zeros(0,dtype=object)
+    pos=np.concatenate(pos) if pos else np.zeros(0,dtype=np.int64)
+    np.save(os.path.join(tmp,'pos.npy'),pos)
+    for name,values in names.items():
+        values=np.concatenate(values) if values else np.zeros(0,dtype=object)
+        np.save(os.path.join(tmp,'{0}.npy'.format(name)),values.astype(bytes))
+    #Row range of each chromosome, which must be in one block as in a sorted vcf
+    bounds=np.flatnonzero(chroms[1:] != chroms[:-1])+1 if len(chroms) else np.zeros(0,dtype=np.int64)
+    starts=np.concatenate(([0],bounds)).tolist() if len(chroms) else []
+    ends=np.append(bounds,len(chroms)).tolist() if len(chroms) else []
+    ranges={}
+    for s,e in zip(starts,ends):
+        c=str(chroms[s])
+        if c in ranges:
+            shutil.rmtree(tmp)
+            raise ValueError("{0} is not sorted, chromosome {1} is not in one block".format(vcf,c))
+        ranges[c]=[s,e]
+    meta={'version':CACHE_VERSION,'source':os.path.abspath(vcf),'size':stat.st_size,'mtime_ns':stat.st_mtime_ns,
+          'sha1':sha1,'samples':samples,'chroms':ranges,'shape':[len(pos),len(samples),2]}
+    with open(os.path.join(tmp,'meta.json'),'w') as outfile:
+        json.dump(meta,outfile)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp,path)
+    return path
+
+
+class GenoCache(object):
+    """An opened genotype cache. geno, pos, id, ref and alt are memory-mapped, so opening it
+    reads nothing but meta.json"""
+
+    def __init__(self,path):
+        with open(os.path.join(path,'meta.json')) as infile:
+            meta=json.load(infile)
+        self.path=path
+        self.samples=meta['samples']
+        self.chroms={c:tuple(r) for c,r in meta['chroms'].items()}
+        self.geno=np.memmap(os.path.join(path,'geno.bin'),dtype=np.int8,mode='r',shape=tuple(meta['shape'])) if meta['shape'][0] else np.zeros(meta['shape'],dtype=np.int8)
+        self.pos=np.load(os.path.join(path,'pos.npy'),mmap_mode='r')
+        self.id=np.load(os.path.join(path,'id.npy'),mmap_mode='r')
+        self.ref=np.load(os.path.join(path,'ref.npy'),mmap_mode='r')
+        self.alt=np.load(os.path.join(path,'alt.npy'),mmap_mode='r')
+
+    def __len__(self):
+        return len(self.pos)
+
+    def sample_index(self,names):
+        """Column of each sample in names, ValueError if one is not in the vcf"""
+        index=pd.Index(self.samples).get_indexer(list(names))
+        if (index < 0).any():
+            missing=[str(n) for n,i in zip(names,index) if i < 0]
+            raise ValueError("Samples {0} are not in {1}".format(', '.join(missing),self.path))
+        return index
+
+    def region(self,chrom,start=None,end=None):
+        """Slice of the rows of chrom with start <= pos <= end, by binary search"""
+        s,e=self.chroms.get(str(chrom),(0,0))
+        pos=self.pos[s:e]
+        lo=0 if start is None else np.searchsorted(pos,start,side='left')
+        hi=len(pos) if end is None else np.searchsorted(pos,end,side='right')
+        return slice(int(s+lo),int(s+hi))
+
+    def lookup(self,chrom,positions):
+        """Row of each position of chrom, -1 for positions with no site"""
+        s,e=self.chroms.get(str(chrom),(0,0))
+        positions=np.asarray(positions,dtype=np.int64)
+        pos=self.pos[s:e]
+        idx=np.searchsorted(pos,positions,side='left')
+        safe=np.minimum(idx,max(len(pos)-1,0))
+        found=(idx < len(pos)) & (pos[safe] == positions) if len(pos) else np.zeros(len(positions),dtype=bool)
+        return np.where(found,s+idx,-1)
+
+    def sites(self,rows=slice(None)):
+        """pandas df (chrom, pos, id, ref, alt) of the sites in rows"""
+        index=np.arange(len(self))[rows]
+        chrom=np.empty(len(index),dtype=object)
+        for c,(s,e) in self.chroms.items():
+            chrom[(index >= s) & (index < e)]=c
+        return pd.DataFrame({'chrom':chrom,'pos':np.asarray(self.pos[rows]),
+                             'id':np.char.decode(np.asarray(self.id[rows])).astype(object),
+                             'ref':np.char.decode(np.asarray(self.ref[rows])).astype(object),
+                             'alt':np.char.decode(np.asarray(self.alt[rows])).astype(object)})
+
+
+def open_cache(vcf,path=None,rebuild=False):
+    """Opens the genotype cache of vcf, building it first if it is missing or out of date"""
+    path=cache_path(vcf) if path is None else path
+    if rebuild or not is_current(vcf,path):
+        build_cache(vcf,path)
+    return GenoCache(path)
+
+
+if __name__ == "__main__":
+    args=get_args()
+    cache=open_cache(args.vcf,args.out,args.force)
+    print("{0}: {1} sites, {2} samples, chromosomes {3}".format(cache.path,len(cache),len(cache.samples),', '.join(cache.chroms)))
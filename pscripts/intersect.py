@@ -5,32 +5,30 @@ Calculates the interest of parent assignments between Simulated RIL and FILLIN P
 
 import sys
 import argparse
-from subprocess import PIPE,Popen,STDOUT
 import pandas as pd
 import os
+import json
+import hashlib
 import numpy as np
+from multiprocessing import Pool,shared_memory,resource_tracker
 
 def arg_parse():
     parser=argparse.ArgumentParser(description="""Program description""")
     parser.add_argument("actual",type=str,help="""Bed file of actual parental assignments""")
     parser.add_argument("pred",type=str,help="""Bed file of predicted parental assignments""")
+    parser.add_argument("--workers",type=int,default=1,help="""Number of worker processes to score samples in parallel (Default: 1)""")
+    parser.add_argument("--stream",action='store_true',help="""Read both files in blocks of samples instead of loading them, for large populations. Both files must be sorted by sample in the same order""")
+    parser.add_argument("--chunksize",type=int,default=None,help="""Rows read and scored at a time with --stream, or markers read at a time with --genoprob (Default: 100000, 1000 with --genoprob)""")
+    parser.add_argument("--genoprob",action='store_true',help="""Score qtl2 genotype probabilities per marker and per line instead of bed intervals. pred is then the prefix of the array exported by qtl2_array.R""")
+    parser.add_argument("--bins",type=int,default=10,help="""Number of calibration bins of the hard call probability with --genoprob (Default: 10)""")
+    parser.add_argument("--cache",type=str,default=None,help="""JSON file of per sample scores kept between runs, so only samples whose actual or predicted rows changed are scored again. Entries of samples that are not in the input are dropped. Not available with --stream or --genoprob (Default: no cache)""")
     parser.add_argument("--verbose",type=str,help="""Print out full output, with per parent percentages""")
     args = parser.parse_args()
+    if args.cache is not None and (args.stream or args.genoprob):
+        parser.error("--cache can not be used with --stream or --genoprob")
     return args
 
 
-def get_total(pred):
-    """Calculates the total number of base pairs that were predicted in a bedfile"""
-    total=0
-    with open(pred,'r') as full:
-        for line in full:
-            l = line.split('\t')
-            start = int(l[1])
-            end = int(l[2])
-            total+= end-start
-    return total
-
-
 #def percent_guess(actual,pred):
 #    """Calculates the proportion of the actual individual that was predicted"""
 #    all_pred=get_total(pred)
@@ -39,95 +37,520 @@ def get_total(pred):
 #    return round(float(diff)/all_actual,3)
 
 
-def percent_heterozygous(infile):
-    """Calculates the percentage of heterozygous calls in a sample"""
-    df = pd.read_table(infile)
-    fulltotal=sum(df['end']-df['start'])
+def heterozygous_bp(df):
+    """Returns the bp of heterozygous calls and the total bp in the predicted table"""
+    fulltotal=int((df['end']-df['start']).sum())
     hetdf = df[df['donor1'] != df['donor2']]
-    perc_het = sum(hetdf['end']-hetdf['start'])
+    return int((hetdf['end']-hetdf['start']).sum()),fulltotal
+
+
+def percent_heterozygous(df):
+    """Calculates the percentage of heterozygous calls in the predicted table"""
+    perc_het,fulltotal=heterozygous_bp(df)
     return round(float(perc_het)/fulltotal,3),fulltotal
 
 
-def split_actual(infile):
-    """Splits the Actual infile into separate files for each sample and chromosome
-    Returns the lists of sample names, unique parent names, and chromosomes"""
-    df = pd.read_table(infile)
-    seg='A'
-    outtag='.bed'
+def actual_info(df):
+    """Returns the lists of sample names, chromosomes and unique parent names in the Actual table"""
     samples=df.iloc[:,0].unique()
     chroms=df.iloc[:,1].unique()
     parents=df['donor1'].unique()
-    for i in samples:
-        for c in chroms:
-            count=1
-            txt=''
-            locs=df[df.iloc[:,0]==i]
-            for index,row in locs.iterrows():
-                start = row['start']
-                end = row['end']
-                txt+='{0}\t{1}\t{2}\t{3}\n'.format(c,start,end,row['donor1']+'_'+str(count)+seg)
-                count+=1
-            with open('tmp/'+i+'_'+str(c)+outtag,'w') as outfile:
-                outfile.write(txt)
     return samples,chroms,parents
 
 
-def split_predicted(infile,samples,chroms):
-    """Splits the predicted infile into separate files for each sample and chromosome. If 
-    a heterozygous call, creates duplicate files for bot of the predicted donors"""
-    df = pd.read_table(infile)
-    seg='B'
-    outtag='_pred.bed'
-    for i in samples:
-        for c in chroms:
-            count=1
-            txt=''
-            locs=df[df['sample']==i]
-            for index,row in locs.iterrows():
-                start=row['start']
-                end=row['end']
-                txt+='{0}\t{1}\t{2}\t{3}\n'.format(c,start,end,row['donor1']+'_'+str(count)+seg)
-                if row['donor1']!=row['donor2']:
-                    txt+='{0}\t{1}\t{2}\t{3}\n'.format(c,start,end,row['donor2']+'_'+str(count)+seg)
-                count+=1
-            with open('tmp/'+i+'_'+str(c)+outtag,'w') as outfile:
-                outfile.write(txt)
-
-    
-def split_parents(p,infile,outfile):
-    """Separates a file from split_samples (predicted or actual) into individual files by parent
-    if prediected file, checks if the parent is in the file. If not, it returns False, otherwise True"""
-    txt=''
-    hasparent=False
-    with open(infile,'r') as full:
-        for line in full:
-            if p in line.split('\t')[3]:
-                txt+=line
-                hasparent=True
-    if hasparent:
-        with open(outfile,'w') as pfile:
-            pfile.write(txt)
-    return hasparent
-
-        
-def call_bedtools(afile,bfile):
-    """System calls bedtools, which calculates the interection between afile and bfile. The two files
-    should be from the same parent"""
-    process = Popen(['bedtools','intersect','-wao','-a',afile,'-b',bfile],stdout=PIPE,stderr=STDOUT)
-    stdout,stderr = process.communicate()
-    return stdout
-
-
-def get_overlap(stdout):
-    """Takes in the output of call_bedtools and returns the total overlap between predicted and actual
-    parental regions"""
-    overlap=[]
-    lines = stdout.split('\n')
-    for l in lines[:-1]:
-        t = l.split('\t')
-        o = int(t[-1])
-        overlap.append(o)
-    return sum(overlap)
+def expand_predicted(df):
+    """Returns the predicted table with one row per predicted donor. A heterozygous call
+    becomes two rows, one for each of the predicted donors, both counted towards the
+    predicted total"""
+    het=df[df['donor1'] != df['donor2']]
+    hom=df[['sample','chr','start','end','donor1']]
+    het=het[['sample','chr','start','end','donor2']].rename(columns={'donor2':'donor1'})
+    return pd.concat([hom,het],ignore_index=True)
+
+
+def group_codes(df,samples,chroms,parents):
+    """Integer codes of the sample, chromosome and donor of every row, -1 where the
+    value is not in samples, chroms or parents"""
+    s=pd.Index(samples).get_indexer(df.iloc[:,0]).astype(np.int64)
+    c=pd.Index([str(i) for i in chroms]).get_indexer(df.iloc[:,1].astype(str)).astype(np.int64)
+    p=pd.Index(parents).get_indexer(df['donor1']).astype(np.int64)
+    return s,c,p
+
+
+def grouped_overlap_bp(agroup,astart,aend,bgroup,bstart,bend,ngroups):
+    """Sweep-line intersection of two sets of bed (half-open) intervals, split into groups.
+    Returns an array with, for each group, the total number of base pairs shared by every
+    pair of an a interval and a b interval of that group. This is the sum of the overlap
+    column of bedtools intersect -wao -a a -b b run separately on each group.
+    Intervals within a set may overlap each other, as the pairs are counted separately
+    """
+    if len(astart) == 0 or len(bstart) == 0:
+        return np.zeros(ngroups,dtype=np.int64)
+    #Give each group its own stretch of the number line so one sweep covers all groups
+    width=np.int64(max(aend.max(),bend.max()))+1
+    astart=agroup*width+astart
+    aend=agroup*width+aend
+    bstart=bgroup*width+bstart
+    bend=bgroup*width+bend
+    #The number of a and b intervals covering each piece between consecutive interval edges
+    edges=np.unique(np.concatenate((astart,aend,bstart,bend)))
+    acover=np.searchsorted(np.sort(astart),edges[:-1],side='right')-np.searchsorted(np.sort(aend),edges[:-1],side='right')
+    bcover=np.searchsorted(np.sort(bstart),edges[:-1],side='right')-np.searchsorted(np.sort(bend),edges[:-1],side='right')
+    return np.bincount(edges[:-1]//width,weights=acover*bcover*np.diff(edges),minlength=ngroups)[:ngroups].astype(np.int64)
+
+
+def overlap_bp(astart,aend,bstart,bend):
+    """Total number of base pairs shared by every pair of an a interval and a b interval,
+    see grouped_overlap_bp()"""
+    zeros=np.zeros(len(astart),dtype=np.int64)
+    return int(grouped_overlap_bp(zeros,np.asarray(astart),np.asarray(aend),np.zeros(len(bstart),dtype=np.int64),np.asarray(bstart),np.asarray(bend),1)[0])
+
+
+def interval_arrays(df,samples,chroms,parents):
+    """Converts a table to the numeric arrays used for scoring: sample, chromosome and
+    parent codes (-1 for donors not in parents), start and end. Rows from other samples
+    or chromosomes are dropped and rows are sorted by sample"""
+    s,c,p=group_codes(df,samples,chroms,parents)
+    ok=(s >= 0) & (c >= 0)
+    order=np.argsort(s[ok],kind='stable')
+    return {'sample':s[ok][order],'chrom':c[ok][order],'parent':p[ok][order],
+            'start':df['start'].values.astype(np.int64)[ok][order],
+            'end':df['end'].values.astype(np.int64)[ok][order]}
+
+
+def score_arrays(a,b,s0,s1,nc,np_):
+    """Scores samples s0..s1-1 with grouped array operations
+    Input:
+    a,b: actual and (expanded) predicted interval_arrays()
+    s0,s1: range of sample codes to score
+    nc,np_: number of chromosomes and parents
+
+    Output:
+    a_total,total: bp in the actual and predicted tables per sample and chromosome
+    p_total,right,shared: predicted bp, correctly predicted bp, and whether the parent is
+    in both tables, per sample, chromosome and parent
+    """
+    ns=s1-s0
+    ngroups=ns*nc*np_
+    out=[]
+    for t in (a,b):
+        rows=slice(np.searchsorted(t['sample'],s0,side='left'),np.searchsorted(t['sample'],s1,side='left'))
+        s=t['sample'][rows]-s0
+        c=t['chrom'][rows]
+        p=t['parent'][rows]
+        start=t['start'][rows]
+        end=t['end'][rows]
+        total=np.bincount(s*nc+c,weights=end-start,minlength=ns*nc).astype(np.int64)
+        ok=p >= 0
+        g=((s*nc+c)*np_+p)[ok]
+        out.append((total,g,start[ok],end[ok]))
+    (a_total,a_g,a_start,a_end),(total,b_g,b_start,b_end)=out
+    p_total=np.bincount(b_g,weights=b_end-b_start,minlength=ngroups).astype(np.int64)
+    right=grouped_overlap_bp(a_g,a_start,a_end,b_g,b_start,b_end,ngroups)
+    shared=(np.bincount(a_g,minlength=ngroups) > 0) & (np.bincount(b_g,minlength=ngroups) > 0)
+    return a_total,total,p_total,right,shared
+
+
+def per_parent_dicts(samples,chroms,parents,result):
+    """Converts the output of score_arrays() for samples to dicts,
+    scores[sample][chrom] is the per_parent dict of that sample and chromosome"""
+    a_total,total,p_total,right,shared=result
+    nc,np_=len(chroms),len(parents)
+    scores={}
+    for i,r in enumerate(samples):
+        scores[r]={}
+        for j,c in enumerate(chroms):
+            k=i*nc+j
+            g=slice(k*np_,(k+1)*np_)
+            per_parent={"parent":list(parents),"perc_correct":[],"perc_guess":0,"right":0,"total":0}
+            per_parent['total']=int(total[k])
+            per_parent['a_total']=int(a_total[k])
+            per_parent['pguess']=round(float(total[k])/a_total[k],3) if a_total[k] else 0
+            per_parent['right']=int(right[g][shared[g]].sum())
+            per_parent['perc_correct']=[round(float(x)/t,3) if ok and t else 0 for x,t,ok in zip(right[g],p_total[g],shared[g])]
+            scores[r][c]=per_parent
+    return scores
+
+
+def share_arrays(arrays):
+    """Copies a dict of arrays into shared memory blocks
+    Returns: the SharedMemory blocks (to close and unlink when done), and the
+    name, shape and dtype of each array for attach_arrays()"""
+    blocks=[]
+    meta={}
+    for name,arr in arrays.items():
+        shm=shared_memory.SharedMemory(create=True,size=max(arr.nbytes,1))
+        np.ndarray(arr.shape,dtype=arr.dtype,buffer=shm.buf)[:]=arr
+        blocks.append(shm)
+        meta[name]=(shm.name,arr.shape,arr.dtype.str)
+    return blocks,meta
+
+
+def attach_arrays(meta):
+    """Read-only views of the arrays described by meta, from share_arrays()"""
+    blocks=[]
+    arrays={}
+    for name,(shm_name,shape,dtype) in meta.items():
+        shm=shared_memory.SharedMemory(name=shm_name)
+        arr=np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+        arr.flags.writeable=False
+        blocks.append(shm)
+        arrays[name]=arr
+    return blocks,arrays
+
+
+_worker={}
+
+
+def init_worker(chroms,parents):
+    """Pool initializer: keeps the chromosomes and parents shared by every batch"""
+    _worker['info']=(chroms,parents)
+    _worker['meta']=None
+    _worker['blocks']=[]
+
+
+def attach_batch(ameta,bmeta):
+    """Attaches the shared interval arrays of a batch, once per worker and batch, closing
+    those of the previous batch"""
+    if _worker['meta'] == (ameta,bmeta):
+        return
+    _worker.pop('a',None)
+    _worker.pop('b',None)
+    for shm in _worker['blocks']:
+        shm.close()
+    ablocks,_worker['a']=attach_arrays(ameta)
+    bblocks,_worker['b']=attach_arrays(bmeta)
+    _worker['blocks']=ablocks+bblocks
+    _worker['meta']=(ameta,bmeta)
+
+
+def score_task(task):
+    """Scores the samples with codes s0..s1-1 of a batch in a worker process"""
+    ameta,bmeta,samples,s0,s1=task
+    attach_batch(ameta,bmeta)
+    chroms,parents=_worker['info']
+    result=score_arrays(_worker['a'],_worker['b'],s0,s1,len(chroms),len(parents))
+    return per_parent_dicts(samples,chroms,parents,result)
+
+
+def score_pool(chroms,parents,workers):
+    """Process pool for score(), which can be reused by every call with the same chroms
+    and parents"""
+    #Workers must share the resource tracker of this process, which unlinks the arrays of
+    #each batch, or their own trackers report the arrays as leaked
+    resource_tracker.ensure_running()
+    return Pool(workers,initializer=init_worker,initargs=(list(chroms),list(parents)))
+
+
+def score(actual,pred,samples,chroms,parents,workers=1,pool=None):
+    """Calculates the percentage correctly assigned per parent for every sample and
+    chromosome with grouped array operations on the two tables
+    Input:
+    actual: pandas df of actual parental assignments
+    pred: pandas df of predicted parental assignments
+    samples,chroms,parents: output of actual_info()
+    workers: (int) number of worker processes. With more than one, samples are spread
+    across a process pool that reads the interval arrays from shared memory (Default: 1)
+    pool: pool of worker processes from score_pool() to use instead of starting one
+    (Default: None)
+
+    Output:
+    dict of dicts, scores[sample][chrom] is the per_parent dict of that sample and chromosome
+    """
+    a=interval_arrays(actual,samples,chroms,parents)
+    b=interval_arrays(expand_predicted(pred),samples,chroms,parents)
+    if workers <= 1:
+        result=score_arrays(a,b,0,len(samples),len(chroms),len(parents))
+        return per_parent_dicts(samples,chroms,parents,result)
+    edges=np.linspace(0,len(samples),min(workers*4,len(samples))+1).astype(int)
+    ablocks,ameta=share_arrays(a)
+    bblocks,bmeta=share_arrays(b)
+    scores={}
+    try:
+        own=pool is None
+        if own:
+            pool=score_pool(chroms,parents,workers)
+        try:
+            tasks=[(ameta,bmeta,list(samples[s0:s1]),s0,s1) for s0,s1 in zip(edges[:-1],edges[1:])]
+            for part in pool.imap(score_task,tasks):
+                scores.update(part)
+        finally:
+            if own:
+                pool.close()
+                pool.join()
+    finally:
+        for shm in ablocks+bblocks:
+            shm.close()
+            shm.unlink()
+    return scores
+
+
+def table_info(path,chunksize=100000):
+    """actual_info() of the table at path, read chunksize rows at a time"""
+    samples={}
+    chroms={}
+    parents={}
+    for chunk in pd.read_table(path,chunksize=chunksize):
+        samples.update(dict.fromkeys(chunk.iloc[:,0].unique()))
+        chroms.update(dict.fromkeys(chunk.iloc[:,1].unique()))
+        parents.update(dict.fromkeys(chunk['donor1'].unique()))
+    return list(samples),list(chroms),list(parents)
+
+
+def sample_blocks(path,chunksize=100000):
+    """Yields (sample, df) for each sample in the table at path, which must have all rows of
+    a sample next to each other. The table is read chunksize rows at a time, so at most one
+    chunk and one sample are held in memory"""
+    seen=set()
+    name=None
+    pending=[]
+    for chunk in pd.read_table(path,chunksize=chunksize):
+        names=chunk.iloc[:,0].values
+        starts=np.concatenate(([0],np.flatnonzero(names[1:] != names[:-1])+1))
+        ends=np.append(starts[1:],len(chunk))
+        for i,j in zip(starts,ends):
+            if names[i] == name:
+                pending.append(chunk.iloc[i:j])
+                continue
+            if pending:
+                seen.add(name)
+                yield name,pd.concat(pending)
+            name=names[i]
+            if name in seen:
+                raise ValueError("{0} is not sorted by sample, {1} is not in one block of rows".format(path,name))
+            pending=[chunk.iloc[i:j]]
+    if pending:
+        yield name,pd.concat(pending)
+
+
+def stream_score(actual_path,pred_path,chunksize=100000,workers=1):
+    """score() for tables too large to load, reading sample blocks of both tables in lockstep.
+    Both tables must be sorted by sample in the same order, predicted samples not in the
+    actual table are only counted in the heterozygous and predicted totals. Samples are
+    scored in batches of about chunksize rows, so memory is bounded by the chunk size and
+    the largest sample. With workers > 1 every batch is scored by the same process pool
+
+    Output:
+    scores, samples, chroms and parents as from score() and actual_info(), and the
+    percent_heterozygous() of the predicted table
+    """
+    samples,chroms,parents=table_info(actual_path,chunksize)
+    #Batches without predicted rows are scored against an empty predicted table
+    empty=pd.read_table(pred_path,nrows=0)
+    order={r:i for i,r in enumerate(samples)}
+    preds=sample_blocks(pred_path,chunksize)
+    scores={}
+    het_total=0
+    fulltotal=0
+    batch=[]
+    abatch=[]
+    pbatch=[]
+    rows=0
+    pool=score_pool(chroms,parents,workers) if workers > 1 else None
+    try:
+        nxt=next(preds,None)
+        for i,(name,block) in enumerate(sample_blocks(actual_path,chunksize)):
+            #Consume the predicted blocks up to and including this sample
+            while nxt is not None and order.get(nxt[0],-1) <= i:
+                pname,pblock=nxt
+                het,total=heterozygous_bp(pblock)
+                het_total+=het
+                fulltotal+=total
+                if pname == name:
+                    pbatch.append(pblock)
+                    rows+=len(pblock)
+                elif pname in order:
+                    raise ValueError("{0} is not in the same sample order as {1}, found {2} after {3}".format(pred_path,actual_path,pname,name))
+                nxt=next(preds,None)
+            batch.append(name)
+            abatch.append(block)
+            rows+=len(block)
+            if rows >= chunksize:
+                scores.update(score(pd.concat(abatch),pd.concat(pbatch) if pbatch else empty,batch,chroms,parents,workers,pool))
+                batch,abatch,pbatch,rows=[],[],[],0
+        if batch:
+            scores.update(score(pd.concat(abatch),pd.concat(pbatch) if pbatch else empty,batch,chroms,parents,workers,pool))
+        while nxt is not None:
+            pname,pblock=nxt
+            if pname in order:
+                raise ValueError("{0} is not in the same sample order as {1}, found {2} after the last sample".format(pred_path,actual_path,pname))
+            het,total=heterozygous_bp(pblock)
+            het_total+=het
+            fulltotal+=total
+            nxt=next(preds,None)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return scores,samples,chroms,parents,(round(float(het_total)/fulltotal,3),fulltotal)
+
+
+def read_genoprobs(prefix):
+    """Opens the genotype probabilities of one chromosome exported by qtl2_array.R.
+    prefix.bin holds the lines x founders x markers array of calc_genoprob() as float64
+    in R (column-major) order, so it is memory-mapped here as markers x founders x lines
+    and each marker is one contiguous block. prefix.lines.txt and prefix.founders.txt
+    list the line and founder names, prefix.markers.csv the markers (marker,chr,pos in Mb)
+
+    Returns: line names, founder names, marker table, and the memory-mapped array
+    """
+    with open(prefix+'.lines.txt') as infile:
+        lines=[l.strip() for l in infile if l.strip()]
+    with open(prefix+'.founders.txt') as infile:
+        founders=[l.strip() for l in infile if l.strip()]
+    markers=pd.read_csv(prefix+'.markers.csv')
+    probs=np.memmap(prefix+'.bin',dtype='<f8',mode='r',shape=(len(markers),len(founders),len(lines)))
+    return lines,founders,markers,probs
+
+
+def truth_lookup(actual,lines,founders,chrom):
+    """Sorted interval keys of the actual table on chrom for the lines of a genoprob array,
+    for true_founders(). Lines and founders are given by their index in lines and founders"""
+    df=actual[actual.iloc[:,1].astype(str) == str(chrom)]
+    l=pd.Index(lines).get_indexer(df.iloc[:,0].astype(str))
+    ok=l >= 0
+    width=np.int64(df['end'].max())+1 if len(df) else np.int64(1)
+    key=l[ok]*width+df['start'].values[ok].astype(np.int64)
+    order=np.argsort(key,kind='stable')
+    return {'key':key[order],'line':l[ok][order],'end':df['end'].values[ok][order].astype(np.int64),
+            'donor1':pd.Index(founders).get_indexer(df['donor1'])[ok][order],
+            'donor2':pd.Index(founders).get_indexer(df['donor2'])[ok][order],'width':width}
+
+
+def true_founders(truth,pos,nlines):
+    """Founder indexes of donor1 and donor2 of every line at the marker positions pos,
+    as two markers x lines arrays with -1 where the line has no interval or an unknown donor"""
+    pos=np.asarray(pos,dtype=np.int64)
+    if len(truth['key']) == 0:
+        return np.full((len(pos),nlines),-1),np.full((len(pos),nlines),-1)
+    q=np.arange(nlines,dtype=np.int64)[None,:]*truth['width']+np.minimum(pos,truth['width']-1)[:,None]
+    idx=np.searchsorted(truth['key'],q,side='right')-1
+    safe=np.maximum(idx,0)
+    found=(idx >= 0) & (truth['line'][safe] == np.arange(nlines)[None,:]) & (pos[:,None] <= truth['end'][safe])
+    d1=np.where(found,truth['donor1'][safe],-1)
+    d2=np.where(found,truth['donor2'][safe],-1)
+    return d1,d2
+
+
+def genoprob_score(actual,prefix,chunk=1000,nbins=10,marker_out=None):
+    """Marker-level accuracy of qtl2 genotype probabilities against the simulated truth.
+    The array is read chunk markers at a time. A heterozygous true call counts half of the
+    probability of each donor, and a hard call (most probable founder) is correct if it is
+    either donor
+    Input:
+    actual: pandas df of actual parental assignments
+    prefix: genotype probabilities from qtl2_array.R, see read_genoprobs()
+    chunk: (int) number of markers read at a time
+    nbins: (int) number of calibration bins of the hard call probability
+    marker_out: (str) file the per marker table is written to chunk by chunk (Default: not written)
+
+    Output:
+    per line table (lines, markers, mean posterior on the true founder, hard call concordance),
+    calibration table (bin, calls, mean probability, proportion correct), and the totals
+    """
+    lines,founders,markers,probs=read_genoprobs(prefix)
+    chrom=markers['chr'].iloc[0]
+    pos=np.round(markers['pos'].values*1e6).astype(np.int64)
+    truth=truth_lookup(actual,lines,founders,chrom)
+    nlines=len(lines)
+    line_n=np.zeros(nlines,dtype=np.int64)
+    line_mass=np.zeros(nlines)
+    line_right=np.zeros(nlines,dtype=np.int64)
+    bin_n=np.zeros(nbins,dtype=np.int64)
+    bin_p=np.zeros(nbins)
+    bin_right=np.zeros(nbins)
+    for i in range(0,len(pos),chunk):
+        p=np.asarray(probs[i:i+chunk])
+        d1,d2=true_founders(truth,pos[i:i+chunk],nlines)
+        valid=(d1 >= 0) & (d2 >= 0)
+        mass=(np.take_along_axis(p,np.maximum(d1,0)[:,None,:],axis=1)[:,0,:]+np.take_along_axis(p,np.maximum(d2,0)[:,None,:],axis=1)[:,0,:])/2
+        mass=np.where(valid,mass,0)
+        call=p.argmax(axis=1)
+        right=valid & ((call == d1) | (call == d2))
+        conf=p.max(axis=1)
+        n=valid.sum(axis=1)
+        line_n+=valid.sum(axis=0)
+        line_mass+=mass.sum(axis=0)
+        line_right+=right.sum(axis=0)
+        b=np.minimum((conf[valid]*nbins).astype(np.int64),nbins-1)
+        bin_n+=np.bincount(b,minlength=nbins)
+        bin_p+=np.bincount(b,weights=conf[valid],minlength=nbins)
+        bin_right+=np.bincount(b,weights=right[valid],minlength=nbins)
+        if marker_out is not None:
+            with np.errstate(invalid='ignore',divide='ignore'):
+                mdf=pd.DataFrame({'marker':markers['marker'].values[i:i+chunk],'chr':chrom,'pos':pos[i:i+chunk],'lines':n,
+                                  'true_prob':np.round(mass.sum(axis=1)/n,4),'concordance':np.round(right.sum(axis=1)/n,4)})
+            mdf.to_csv(marker_out,sep='\t',index=False,mode='w' if i == 0 else 'a',header=i == 0)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        per_line=pd.DataFrame({'line':lines,'markers':line_n,'true_prob':np.round(line_mass/line_n,4),
+                               'concordance':np.round(line_right/line_n,4)})
+        calibration=pd.DataFrame({'bin':['{0:.2f}-{1:.2f}'.format(float(j)/nbins,float(j+1)/nbins) for j in range(nbins)],
+                                  'calls':bin_n,'mean_prob':np.round(bin_p/bin_n,4),'correct':np.round(bin_right/bin_n,4)})
+    total=line_n.sum()
+    if total == 0:
+        raise ValueError("No lines or markers of {0} are in the actual table".format(prefix))
+    totals={'true_prob':round(float(line_mass.sum())/total,3),'concordance':round(float(line_right.sum())/total,3)}
+    return per_line,calibration,totals
+
+
+# Bump when the scoring changes, so cached scores from older versions are not reused
+CACHE_VERSION=1
+
+
+def sample_hashes(df,samples):
+    """Content hash of the rows of each sample in df, in the order of samples.
+    Samples without rows get the hash of no rows"""
+    s=pd.Index(samples).get_indexer(df.iloc[:,0])
+    rows=pd.util.hash_pandas_object(df,index=False).values
+    order=np.argsort(s,kind='stable')
+    bounds=np.searchsorted(s[order],np.arange(len(samples)+1))
+    rows=rows[order]
+    return [hashlib.sha1(rows[bounds[i]:bounds[i+1]].tobytes()).hexdigest() for i in range(len(samples))]
+
+
+def score_keys(actual,pred,samples,chroms,parents):
+    """Cache key of every sample: a hash of its actual and predicted rows and of the
+    chromosomes and parents it is scored against"""
+    context=json.dumps([CACHE_VERSION,[str(c) for c in chroms],[str(p) for p in parents]])
+    return [hashlib.sha1('{0}{1}{2}'.format(context,a,p).encode()).hexdigest()
+            for a,p in zip(sample_hashes(actual,samples),sample_hashes(pred,samples))]
+
+
+def load_cache(path):
+    """Reads the score cache written by save_cache(), empty if it does not exist"""
+    if path is None or not os.path.isfile(path):
+        return {}
+    with open(path) as infile:
+        return json.load(infile)
+
+
+def save_cache(cache,path):
+    """Writes the score cache, replacing the old file only once the new one is complete"""
+    tmp='{0}.{1}.tmp'.format(path,os.getpid())
+    with open(tmp,'w') as outfile:
+        json.dump(cache,outfile)
+    os.replace(tmp,path)
+
+
+def cached_score(actual,pred,samples,chroms,parents,path,workers=1,verbose=False):
+    """score() that only scores the samples whose rows changed since the last run.
+    Per sample scores are kept in the JSON file at path, keyed by score_keys(), and
+    samples with a cached key are read back instead of being scored again. Only the keys
+    of samples are kept, so entries of changed or removed samples do not accumulate"""
+    keys=score_keys(actual,pred,samples,chroms,parents)
+    old=load_cache(path)
+    cache={k:old[k] for k in keys if k in old}
+    todo=[r for r,k in zip(samples,keys) if k not in cache]
+    if verbose:
+        print("Scoring {0} of {1} samples, {2} cached".format(len(todo),len(samples),len(samples)-len(todo)))
+    if todo:
+        new=score(actual[actual.iloc[:,0].isin(todo)],pred[pred.iloc[:,0].isin(todo)],todo,chroms,parents,workers)
+        for r,k in zip(samples,keys):
+            if r in new:
+                cache[k]={str(c):new[r][c] for c in chroms}
+    if todo or len(cache) != len(old):
+        save_cache(cache,path)
+    return {r:{c:cache[k][str(c)] for c in chroms} for r,k in zip(samples,keys)}
 
 
 def format_out(all_samples,samples,chroms):
@@ -153,75 +576,62 @@ def format_out(all_samples,samples,chroms):
     return txt
 
 
-def intersect(sample,c,parents):
-    """Calculates the percentage correctly assigned in a sample per parent and in total""" 
-    r_actual = 'tmp/{0}_{1}.bed'.format(sample,c)
-    r_pred='tmp/{0}_{1}_pred.bed'.format(sample,c)
-    r_pred_all='tmp/{0}_{1}_pred_all.bed'.format(sample,c)
-    total=get_total(r_pred)
-    a_total=get_total(r_actual)
-    per_parent={"parent":[],"perc_correct":[],"perc_guess":0,"right":0,"total":0}
-    per_parent['total']=total
-    per_parent['a_total']=a_total
-    per_parent['pguess']=round(float(total)/a_total,3)
-    for p in parents:
-        afile='tmp/{0}_{1}_{2}.bed'.format(sample,c,p)
-        bfile='tmp/{0}_{1}_{2}_pred.bed'.format(sample,c,p)
-        if split_parents(p,r_actual,afile) and split_parents(p,r_pred,bfile):
-            p_total = get_total(bfile)
-            out = call_bedtools(afile,bfile)
-            right = get_overlap(out)
-            per_parent['parent'].append(p)
-            per_parent['right']+=right
-            per_parent['perc_correct'].append(round(float(right)/p_total,3))
-        else:
-            per_parent['parent'].append(p)
-            per_parent['perc_correct'].append(0)
-<<<<<<< HEAD
-            #print('Parent {0} not shared between actual and predicted in sample {1} chr {2}\n').format(p,sample,c)
-=======
->>>>>>> 18f7342e0dd2677cde1342267547146b8a4bd01f
-    return per_parent
-
-def main():
-    args = arg_parse()
-    actual = args.actual
-    pred = args.pred
-    samples,chroms,parents=split_actual(actual)
-    split_predicted(pred,samples,chroms)
+def summarize(scores,samples,chroms,het,fulltotal):
+    """Combines the per sample and chromosome scores into the all_samples dictionary
+    printed by format_out()
+    Input:
+    scores: output of score()
+    het,fulltotal: output of percent_heterozygous() on the predicted table
+    """
     all_samples= {}
     pright=0
     ptotal=0
     for r in samples:
-        all_samples[r]={}
+        all_samples[r]=dict(scores[r])
         r_total=0
         r_right=0
-        r_guess=0
         a_total=0
         for c in chroms:
-            all_samples[r][c] = intersect(r,c,parents)
-            a_total+=(all_samples[r][c]['a_total'])
-            pright+=(all_samples[r][c]['right'])
-            ptotal+=(all_samples[r][c]['total'])
-            r_right+=(all_samples[r][c]['right'])
-            r_total+=(all_samples[r][c]['total'])
+            a_total+=(scores[r][c]['a_total'])
+            pright+=(scores[r][c]['right'])
+            ptotal+=(scores[r][c]['total'])
+            r_right+=(scores[r][c]['right'])
+            r_total+=(scores[r][c]['total'])
         all_samples[r]['total']=round(float(r_right)/r_total,3)
         all_samples[r]['pguess']=round(float(r_total)/a_total,3)
-    all_samples['het'],fulltotal=percent_heterozygous(pred)
+    all_samples['het']=het
     all_samples['fulltotal'] = round(float(pright)/fulltotal,3)
     all_samples['homozygoustotal']=round(float(pright)/ptotal,3)
     all_samples['percentguess']=round(np.mean([all_samples[r]['pguess'] for r in samples]),3)
+    return all_samples
+
+
+def main():
+    args = arg_parse()
+    if args.genoprob:
+        actual = pd.read_table(args.actual)
+        per_line,calibration,totals=genoprob_score(actual,args.pred,args.chunksize or 1000,args.bins,'intersect_genoprob_markers.txt')
+        per_line.to_csv('intersect_genoprob_lines.txt',sep='\t',index=False)
+        calibration.to_csv('intersect_genoprob_calibration.txt',sep='\t',index=False)
+        print('Mean Probability of True Founder: {0}'.format(totals['true_prob']))
+        print('Proportion of Hard Calls Correct: {0}'.format(totals['concordance']))
+        return
+    if args.stream:
+        scores,samples,chroms,parents,(het,fulltotal)=stream_score(args.actual,args.pred,args.chunksize or 100000,args.workers)
+    else:
+        actual = pd.read_table(args.actual)
+        pred = pd.read_table(args.pred)
+        samples,chroms,parents=actual_info(actual)
+        if args.cache:
+            scores=cached_score(actual,pred,samples,chroms,parents,args.cache,args.workers,args.verbose is not None)
+        else:
+            scores=score(actual,pred,samples,chroms,parents,args.workers)
+        het,fulltotal=percent_heterozygous(pred)
+    all_samples=summarize(scores,samples,chroms,het,fulltotal)
     output = format_out(all_samples,samples,chroms)
     with open('intersect_output.txt','w') as outfile:
         outfile.write(output)
 
 
 if __name__ == "__main__":
-    #assert (os.path.isdir('tmp/')==False,"The directory tmp/ already exists")
-    process = Popen(['mkdir','tmp'],stdout=PIPE,stderr=PIPE)
     main()
-<<<<<<< HEAD
-23576825
-=======
-    process=Popen(['rm','-r','tmp'],stdout=PIPE,stderr=PIPE)
->>>>>>> 18f7342e0dd2677cde1342267547146b8a4bd01f
@@ -6,26 +6,35 @@ Output: file with a list of positions
 import numpy as np
 import argparse
 import sys
-from subprocess import Popen, PIPE
+import bcftools_exec
+import bgzf
 
 def get_args():
     parser=argparse.ArgumentParser(description="""Program description""")
     parser.add_argument("infile",type=str,help="""The input vcf file""")
     parser.add_argument("outfile",type=str,help="""The output regions file""")
     parser.add_argument("m",type=int,help="""The number of markers to select""")
+    parser.add_argument("--in-process",action='store_true',help="""Read the bgzipped vcf in-process (bgzf.py) instead of calling bcftools""")
     args=parser.parse_args()
     return args
 
 def get_regions(infile):
-    process=Popen(['bcftools','view', '-f','%POS\n',infile],stdout=PIPE,stderr=PIPE)
-    stdout,stderr=process.communicate()
+    stdout,stderr=bcftools_exec.run(['query', '-f','%POS\n',infile])
     print(stderr)
-    full = stdout.split('\n')
+    full = stdout.decode().split()
+    return full
+
+
+def read_regions(infile):
+    """get_regions() read in-process from a bgzipped vcf, without bcftools"""
+    reader=bgzf.BgzfReader(infile)
+    full=[line.split(b'\t',2)[1].decode() for voffset,line in reader.lines(0) if line and not line.startswith(b'#')]
+    reader.close()
     return full
 
 def main():
     args=get_args()
-    full = get_regions(args.infile)
+    full = read_regions(args.infile) if args.in_process else get_regions(args.infile)
     markers = np.random.choice(full,args.m,replace=False)
     markers = sorted(map(int,markers))
     txt=""
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+"""
+Builds every R/qtl2 input file of a cross in one job: sample genotypes (geno), founder
+genotypes (founder_geno), physical map (pmap, Mbp), genetic map (gmap, cM interpolated
+from the Ogut 2015 map) and the JSON control file read by read_cross2(), for each
+chromosome. Replaces running genofile2.py, foundergeno.py and pmap.py once per chromosome
+followed by control_file.R. Only the markers found in both vcfs are written, so the maps,
+geno and founder_geno files have the same markers.
+Chromosomes are built in parallel worker processes, each querying its region of the two
+vcfs, so the genotypes of each vcf are read once (the founder marker IDs are read first to
+find the shared markers). Requires bcftools and vcfs indexed with bcftools index or tabix
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+from multiprocessing import Pool
+import pandas as pd
+import genofile2
+import zipbundle
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','pscripts'))
+import approx_cM
+import geno_cache
+
+DATA_DIR=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','data_files')
+
+
+def parse_args():
+    """ -h for info on arguments
+    """
+    parser=argparse.ArgumentParser(description="""Program description: Builds the R/qtl2 geno, founder_geno, pmap, gmap and JSON control files of every chromosome from a vcf of samples and a vcf of founders""")
+    parser.add_argument("samples",type=str,help="""Indexed vcf of the sample (i.e. DH line) genotypes""")
+    parser.add_argument("founders",type=str,help="""Indexed vcf of the founder genotypes""")
+    parser.add_argument("outdir",type=str,help="""Output directory""")
+    parser.add_argument("--prefix",type=str,default='Biogemma',help="""Prefix of the output files, the control files are <prefix>_c<chrom>.json (Default: Biogemma)""")
+    parser.add_argument("--chroms",type=str,nargs='+',default=None,help="""Chromosomes to build (Default: every chromosome of the genetic map, only 10 in data_files/ogut_map.csv)""")
+    parser.add_argument("--map",type=str,default=os.path.join(DATA_DIR,'ogut_map.csv'),help="""Genetic map csv with columns chr, pos (bp) and cM (Default: data_files/ogut_map.csv)""")
+    parser.add_argument("--crosstype",type=str,default='riself16',help="""qtl2 cross type (Default: riself16)""")
+    parser.add_argument("--crossinfo",type=str,default=None,help="""Cross info csv named in the control files, relative to outdir. With --zip it is added to each bundle if it is in outdir (Default: None)""")
+    parser.add_argument("--description",type=str,default=None,help="""Description in the control files, {0} is replaced by the chromosome (Default: '<n> lines from <n> founders, Chromosome <chrom>')""")
+    parser.add_argument("--workers",type=int,default=1,help="""Number of chromosomes built in parallel (Default: 1)""")
+    parser.add_argument("--chunksize",type=int,default=10000,help="""Number of markers read and written at a time (Default: 10000)""")
+    parser.add_argument("--tmpdir",type=str,default=None,help="""Directory for the temporary transpose buffers (Default: outdir)""")
+    parser.add_argument("--cache",action='store_true',help="""Build the binary genotype caches of the vcfs (geno_cache.py) if they are missing or out of date. Current caches are always used""")
+    parser.add_argument("--zip",action='store_true',help="""Write each chromosome as one compressed bundle <prefix>_c<chrom>.zip for read_cross2() instead of separate files""")
+    parser.add_argument("--threads",type=int,default=4,help="""Compression threads per worker with --zip (Default: 4)""")
+    parser.add_argument("--level",type=int,default=6,help="""Compression level 1..9 with --zip (Default: 6)""")
+    args=parser.parse_args()
+    return args
+
+
+def file_names(prefix,chrom):
+    """Names of the files of chrom, relative to the output directory"""
+    return {'geno':'{0}_geno_c{1}.csv'.format(prefix,chrom),
+            'founder_geno':'{0}_foundergeno_c{1}.csv'.format(prefix,chrom),
+            'pmap':'{0}_pmap_c{1}.csv'.format(prefix,chrom),
+            'gmap':'{0}_gmap_c{1}.csv'.format(prefix,chrom),
+            'control':'{0}_c{1}.json'.format(prefix,chrom),
+            'zip':'{0}_c{1}.zip'.format(prefix,chrom)}
+
+
+def control_file(files,crosstype,alleles,crossinfo=None,description=''):
+    """The JSON control file contents of qtl2::write_control_file() for one chromosome,
+    with genotypes coded A=1 (homozygous reference) and B=3 (homozygous alternate)"""
+    control={'description':description,'crosstype':crosstype,'sep':',','na.strings':['NA'],'comment.char':'#',
+             'geno':files['geno'],'founder_geno':files['founder_geno'],'gmap':files['gmap'],'pmap':files['pmap']}
+    if crossinfo is not None:
+        control['cross_info']={'file':crossinfo}
+    control['genotypes']={'A':1,'B':3}
+    control['alleles']=list(alleles)
+    return control
+
+
+class DirBundle(object):
+    """Writes the files of a bundle to a directory, with the same interface as zipbundle.ZipWriter"""
+
+    def __init__(self,outdir):
+        self.outdir=outdir
+
+    def open(self,name):
+        return open(os.path.join(self.outdir,name),'wb')
+
+    def writestr(self,name,data):
+        with self.open(name) as outfile:
+            outfile.write(data.encode() if isinstance(data,str) else data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        pass
+
+
+def write_genotypes(vcf,samples,region,bundle,name,chunksize=10000,tmpdir=None,on_chunk=None,keep=None):
+    """Writes the qtl2 genotype csv of the markers of vcf in region as the file name of bundle,
+    from the genotype cache of vcf if it is current
+    on_chunk: function called with the marker IDs and positions of each chunk written
+    keep: set of the marker IDs to write (Default: all markers)
+    Returns: number of markers written and number of markers read"""
+    cache=genofile2.find_cache(vcf)
+    nread=0
+    with genofile2.TransposeBuffer(len(samples),tmpdir) as buffer:
+        for ids,pos,codes in genofile2.genotype_chunks(vcf,len(samples),chunksize,region,cache):
+            nread+=len(ids)
+            if keep is not None:
+                rows=pd.Series(ids).isin(keep).values
+                ids,pos,codes=ids[rows],pos[rows],codes[rows]
+            buffer.append(ids,codes)
+            if on_chunk is not None:
+                on_chunk(ids,pos)
+        with bundle.open(name) as out:
+            genofile2.write_geno_csv(out,samples,buffer,chunksize)
+        return buffer.nmarkers,nread
+
+
+def chrom_task(task):
+    """Builds the files of one chromosome in a worker process, with only the markers in both vcfs
+    Returns: chromosome, number of markers written, and numbers of sample and founder markers
+    left out as they are not in the other vcf"""
+    chrom,samples_vcf,samples,founders_vcf,founders,gmap,outdir,files,control,chunksize,tmpdir,zipped,threads,level=task
+    if zipped:
+        bundle=zipbundle.ZipWriter(os.path.join(outdir,files['zip']),threads,level)
+    else:
+        bundle=DirBundle(outdir)
+    #The maps go to temporary files while the genotypes are read, as zip members are
+    #written one at a time
+    founder_ids=genofile2.marker_ids(founders_vcf,chrom,genofile2.find_cache(founders_vcf))
+    shared=set()
+    with bundle, tempfile.TemporaryFile(dir=tmpdir) as pmap, tempfile.TemporaryFile(dir=tmpdir) as gfile:
+        def write_maps(ids,pos):
+            shared.update(ids)
+            pmap.write(pd.DataFrame({'marker':ids,'chr':chrom,'pos':pos/1e6}).to_csv(header=False,index=False).encode())
+            gfile.write(pd.DataFrame({'marker':ids,'chr':chrom,'pos':gmap.physical_to_cM(chrom,pos)}).to_csv(header=False,index=False).encode())
+        nmarkers,nsample=write_genotypes(samples_vcf,samples,chrom,bundle,files['geno'],chunksize,tmpdir,write_maps,founder_ids)
+        for name,infile in [(files['pmap'],pmap),(files['gmap'],gfile)]:
+            infile.seek(0)
+            with bundle.open(name) as out:
+                out.write(b'marker,chr,pos\n')
+                shutil.copyfileobj(infile,out,1 << 20)
+        nfounder=write_genotypes(founders_vcf,founders,chrom,bundle,files['founder_geno'],chunksize,tmpdir,keep=shared)[1]
+        bundle.writestr(files['control'],json.dumps(control,indent=2))
+        #read_cross2() needs the cross info file inside the zip
+        crossinfo=control.get('cross_info',{}).get('file')
+        if zipped and crossinfo is not None and os.path.isfile(os.path.join(outdir,crossinfo)):
+            with open(os.path.join(outdir,crossinfo),'rb') as infile, bundle.open(crossinfo) as out:
+                shutil.copyfileobj(infile,out,1 << 20)
+    return chrom,nmarkers,nsample-nmarkers,nfounder-nmarkers
+
+
+def build_bundle(samples_vcf,founders_vcf,outdir,prefix='Biogemma',chroms=None,mapfile=None,crosstype='riself16',
+                 crossinfo=None,description=None,workers=1,chunksize=10000,tmpdir=None,zipped=False,threads=4,level=6,cache=False):
+    """Builds the qtl2 files of every chromosome in chroms
+    Input:
+    samples_vcf, founders_vcf: (str) indexed vcfs of the sample and founder genotypes
+    outdir: (str) output directory
+    prefix: (str) prefix of the output files (Default: Biogemma)
+    chroms: chromosomes (Default: every chromosome of the genetic map)
+    mapfile: (str) genetic map csv (Default: data_files/ogut_map.csv)
+    crosstype: (str) qtl2 cross type (Default: riself16)
+    crossinfo: (str) cross info csv named in the control files (Default: None)
+    description: (str) control file description, {0} is replaced by the chromosome
+    workers: (int) number of worker processes (Default: 1)
+    chunksize: (int) markers read at a time (Default: 10000)
+    tmpdir: (str) directory for the transpose buffers (Default: outdir)
+    zipped: (bool) write each chromosome as one zip bundle (Default: False)
+    threads: (int) compression threads per worker process (Default: 4)
+    level: (int) compression level (Default: 6)
+    cache: (bool) build the genotype caches of the vcfs if they are not current. Current
+    caches are used either way (Default: False)
+
+    Yields: chromosome, number of markers written, and numbers of sample and founder markers
+    left out as they are not in the other vcf, as each chromosome is finished
+    """
+    mapfile=os.path.join(DATA_DIR,'ogut_map.csv') if mapfile is None else mapfile
+    gmap=approx_cM.load_map(mapfile)
+    chroms=gmap.chromosomes() if chroms is None else [str(c) for c in chroms]
+    missing=[c for c in chroms if c not in gmap]
+    if missing:
+        raise ValueError("Chromosomes {0} are not in the genetic map {1}".format(', '.join(missing),mapfile))
+    if cache:
+        for vcf in [samples_vcf,founders_vcf]:
+            geno_cache.open_cache(vcf)
+    samples=genofile2.vcf_samples(samples_vcf)
+    founders=genofile2.vcf_samples(founders_vcf)
+    if description is None:
+        description='{0} lines from {1} founders, Chromosome {{0}}'.format(len(samples),len(founders))
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    tmpdir=outdir if tmpdir is None else tmpdir
+    tasks=[]
+    for c in chroms:
+        files=file_names(prefix,c)
+        control=control_file(files,crosstype,founders,crossinfo,description.format(c))
+        tasks.append((c,samples_vcf,samples,founders_vcf,founders,gmap.subset([c]),outdir,files,control,chunksize,tmpdir,zipped,threads,level))
+    if workers > 1:
+        pool=Pool(min(workers,len(tasks)))
+        results=pool.imap_unordered(chrom_task,tasks)
+    else:
+        pool=None
+        results=(chrom_task(t) for t in tasks)
+    try:
+        for result in results:
+            yield result
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+if __name__ == "__main__":
+    args=parse_args()
+    for chrom,nmarkers,nsample,nfounder in build_bundle(args.samples,args.founders,args.outdir,args.prefix,args.chroms,args.map,args.crosstype,
+                                               args.crossinfo,args.description,args.workers,args.chunksize,args.tmpdir,
+                                               args.zip,args.threads,args.level,args.cache):
+        out=file_names(args.prefix,chrom)['zip' if args.zip else 'control']
+        print("Chromosome {0}: {1} markers written to {2}".format(chrom,nmarkers,os.path.join(args.outdir,out)))
+        if nsample or nfounder:
+            print("Chromosome {0}: left out {1} sample markers not in the founder vcf and {2} founder markers not in the sample vcf".format(chrom,nsample,nfounder))
@@ -1,9 +1,8 @@
 #!/usr/bin/env python
 
-import sys
 import argparse
-from subprocess import Popen,PIPE
 import string
+import genofile2
 
 def parse_args():
     """ -h for info on arguments
@@ -15,76 +14,32 @@ def parse_args():
                                      """)
     parser.add_argument("infile",type=str,help="""The input vcf file""")
     parser.add_argument("outfile",type=str,help="""The output csv filename""")
+    parser.add_argument("--chunksize",type=int,default=10000,help="""Number of markers read and written at a time (Default: 10000)""")
+    parser.add_argument("--tmpdir",type=str,default=None,help="""Directory for the temporary transpose buffer (Default: the directory of outfile)""")
+    parser.add_argument("--cache",action='store_true',help="""Build the binary genotype cache of the vcf (geno_cache.py) if it is missing or out of date. A current cache is always used""")
     args=parser.parse_args()
     return args
 
 def get_founders(vcf):
     """Gets a list of the samples in the vcf file"""
-    process=Popen(["bcftools", "query","-l",vcf],stdout=PIPE,stderr=PIPE)
-    stdout,stderr=process.communicate()
-    print(stderr)
-    founders=stdout.split('\n')[:-1]    
-    return founders
+    return genofile2.vcf_samples(vcf)
 
-def get_tmp(vcf):
-    process=Popen(['bcftools','query','-f','%ID[\tGT=%GT]\n',vcf],stdout=PIPE,stderr=PIPE)
-    stdout,stderr=process.communicate()
-    info = stdout.split('\n')[:-1]
-    print(stderr)
-    return info
+def founder_codes(founders):
+    """Returns the FounderCodes.csv text giving each founder a letter in vcf order"""
+    lcode=string.ascii_uppercase
+    return ''.join('{0},{1}\n'.format(founder,lcode[s]) for s,founder in enumerate(founders))
 
-    
 def get_foundergenofile():
     args=parse_args()
-    txt='ind'
-    geno={}
     founders=get_founders(args.infile)
-    numf=len(founders)
     print(founders)
-    f=''
-    lcode=string.ascii_uppercase
-    for s in range(1,numf+1):
-        geno[s]=[founders[s-1]]
-        f+='{0},{1}\n'.format(founders[s-1],lcode[s-1])
-    print "Writing founder codes to FounderCodes.csv"
+    print("Writing founder codes to FounderCodes.csv")
     with open('FounderCodes.csv','w') as ffile:
-        ffile.write(f)
-    info=get_tmp(args.infile)
-    for i in info:
-        split=i.split('\t')
-        marker = split[0]
-        txt+=','+marker
-        count=1
-        if 2 in split[1:]:
-            for n in split[1:]:
-                if './.' in n:
-                    n='NA'
-                elif '1' in n:
-                    n='A'
-                else:
-                    n='B'
-                geno[count].append(n)
-                count+=1
-        else:
-            for n in split[1:]:
-                if './.' in n:
-                    n='NA'
-                elif '0' in n:
-                    n='A'
-                else:
-                    n='B'
-                geno[count].append(n)
-                count+=1
-    for j in geno.keys():
-        txt+='\n'+ ','.join(geno[j])
-    print "Writing out to {0}".format(args.outfile)
-    with open(args.outfile,'w') as outfile:
-        outfile.write(txt)
+        ffile.write(founder_codes(founders))
+    genofile2.vcf_to_csv(args.infile,args.outfile,args.chunksize,args.tmpdir,args.cache)
 
 
 
 
 if __name__ == "__main__":
     get_foundergenofile()
-
-
@@ -2,83 +2,228 @@
 
 """
 Takes a vcf file and converts it to a csv format with markers as columns and samples as rows
-with nucleotide information in encoded as letters (i.e. A,B,..). Requires bcftools 
+with nucleotide information in encoded as letters (i.e. A,B,..). Requires bcftools
 This csv file is formatted for use with R/qtl2
+
+Markers are read from bcftools in chunks and transposed to samples as rows through a
+buffer on disk, so memory use does not grow with the number of markers.
 """
 
-import pandas as pd
-from subprocess import PIPE,Popen,STDOUT
+import os
 import sys
 import argparse
+import shutil
+import tempfile
+from io import BytesIO
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','pscripts'))
+import bcftools_exec
+import geno_cache
+
+# Output text of each genotype code
+LABELS=np.array([b'NA',b'A',b'B'],dtype=object)
+
 
 def parse_args():
     """ -h for info on arguments
     """
-    parser = argparse.ArgumentParser(description="""Program description: Takes a vcf file and converts it to a csv format with markers as columns and samples as rows             
-with nucleotide information in IUPAC format.                                                             
+    parser = argparse.ArgumentParser(description="""Program description: Takes a vcf file and converts it to a csv format with markers as columns and samples as rows
+with nucleotide information in IUPAC format.
 This csv file is formatted for use with R/qtl2""")
     parser.add_argument("infile",type=str,help="""The input vcf file""")
     parser.add_argument("outfile",type=str,help="""The output csv filename""")
+    parser.add_argument("--chunksize",type=int,default=10000,help="""Number of markers read and written at a time (Default: 10000)""")
+    parser.add_argument("--tmpdir",type=str,default=None,help="""Directory for the temporary transpose buffer, about twice the number of markers x samples bytes (Default: the directory of outfile)""")
+    parser.add_argument("--cache",action='store_true',help="""Build the binary genotype cache of the vcf (geno_cache.py) if it is missing or out of date. A current cache is always used""")
     args=parser.parse_args()
     return args
 
 
-def call_bcftools(infile):
-    """Reads vcf file and extracts data on samples and genotypes for each marker
-    Returns a list of samples and list of markers and genotypes (info)
+def vcf_samples(vcf):
+    """Returns the list of samples in the vcf file"""
+    stdout,stderr=bcftools_exec.run(['query','-l',vcf])
+    return stdout.decode().split()
+
+
+def marker_chunks(vcf,nsamples,chunksize=10000,region=None):
+    """Reads the marker IDs, positions and genotypes of vcf with bcftools, chunksize markers
+    at a time. region (i.e. a chromosome) restricts the query to that region of an indexed vcf
+    Yields: array of marker IDs, array of positions and array (markers x samples) of GT strings
     """
-    process1 = Popen(['bcftools','query','-l',infile],stdout=PIPE,stderr=STDOUT)
-    stdout,stderr=process1.communicate()
-    print(stderr)
-    samples = stdout.split('\n')[:-1]
-    process2 = Popen(['bcftools','query','-f','%ID[\tGT=%GT]\n',infile],stdout=PIPE,stderr=STDOUT)
-    stdout,stderr=process2.communicate()
-    info = stdout.split('\n')[:-1]
-    print(stderr)
-    print "Read vcf file: Contains info on {0} samples and {1} markers".format(len(samples),len(info))
-    return samples,info
+    buf=[]
+    def chunk():
+        df=pd.read_csv(BytesIO(b'\n'.join(buf)),sep='\t',header=None,dtype=str,keep_default_na=False)
+        return df[0].values,df[1].values.astype(np.int64),df.iloc[:,2:2+nsamples].values
+    query=['query','-f','%ID\t%POS[\t%GT]\n']
+    if region is not None:
+        query+=['-r',region]
+    for line in bcftools_exec.lines(query+[vcf]):
+        buf.append(line)
+        if len(buf) == chunksize:
+            yield chunk()
+            buf=[]
+    if buf:
+        yield chunk()
+
+
+def allele_codes(alleles):
+    """Converts int8 allele codes (markers x samples x 2, -1 missing) to qtl2 genotype codes:
+    0 for missing (NA), 1 for genotypes carrying the A allele and 2 otherwise (B). The A
+    allele is the reference, or allele 1 at multi-allelic markers where any genotype has
+    allele 2 or higher"""
+    alleles=np.asarray(alleles)
+    multi=(alleles >= 2).any(axis=(1,2))
+    a=multi.astype(np.int8)[:,None,None]
+    codes=np.where((alleles == a).any(axis=2),1,2).astype(np.int8)
+    codes[(alleles < 0).all(axis=2)]=0
+    return codes
+
+
+def encode_genotypes(gt):
+    """Converts an array (markers x samples) of GT strings to qtl2 genotype codes"""
+    return allele_codes(geno_cache.decode_gt(gt))
+
+
+def find_cache(vcf,build=False):
+    """Returns: the geno_cache.GenoCache of vcf if it is current, building it first if build is
+    True, or None"""
+    if build:
+        return geno_cache.open_cache(vcf)
+    path=geno_cache.cache_path(vcf)
+    if geno_cache.is_current(vcf,path):
+        return geno_cache.GenoCache(path)
+    return None
+
+
+def genotype_chunks(vcf,nsamples,chunksize=10000,region=None,cache=None):
+    """Reads the qtl2 genotype codes of vcf chunksize markers at a time, from its genotype
+    cache if one is given and with bcftools otherwise. region is a chromosome
+    Yields: array of marker IDs, array of positions and codes (markers x samples)
+    """
+    if cache is None:
+        for ids,pos,gt in marker_chunks(vcf,nsamples,chunksize,region):
+            yield ids,pos,encode_genotypes(gt)
+        return
+    rows=slice(0,len(cache)) if region is None else cache.region(region)
+    for start in range(rows.start,rows.stop,chunksize):
+        end=min(start+chunksize,rows.stop)
+        ids=np.char.decode(np.asarray(cache.id[start:end])).astype(object)
+        yield ids,np.asarray(cache.pos[start:end]),allele_codes(cache.geno[start:end])
+
+
+def marker_ids(vcf,region=None,cache=None):
+    """Returns: the set of marker IDs of vcf (in region, a chromosome), from its genotype
+    cache if one is given and with bcftools otherwise"""
+    if cache is None:
+        query=['query','-f','%ID\n']
+        if region is not None:
+            query+=['-r',region]
+        return set(line.decode() for line in bcftools_exec.lines(query+[vcf]))
+    rows=slice(0,len(cache)) if region is None else cache.region(region)
+    return set(np.char.decode(np.asarray(cache.id[rows])))
+
+
+class TransposeBuffer(object):
+    """Collects chunks of genotype codes with markers as rows in a file on disk, then
+    transposes them block by block into a memory-mapped samples x markers matrix"""
+
+    def __init__(self,nsamples,tmpdir=None):
+        self.nsamples=nsamples
+        self.nmarkers=0
+        self.dir=tempfile.mkdtemp(prefix='genofile_',dir=tmpdir)
+        self.markers=open(os.path.join(self.dir,'markers.bin'),'wb')
+        self.ids=open(os.path.join(self.dir,'ids.txt'),'wb')
+        self.matrix=None
+
+    def append(self,ids,codes):
+        self.markers.write(np.ascontiguousarray(codes,dtype=np.int8).tobytes())
+        self.ids.write(b''.join(i.encode()+b'\n' for i in ids))
+        self.nmarkers+=len(ids)
+
+    def transpose(self,chunksize=10000):
+        """Returns: memory-mapped samples x markers matrix of all appended codes"""
+        self.markers.close()
+        self.ids.close()
+        if self.nmarkers == 0 or self.nsamples == 0:
+            self.matrix=np.zeros((self.nsamples,self.nmarkers),dtype=np.int8)
+            return self.matrix
+        markers=np.memmap(os.path.join(self.dir,'markers.bin'),dtype=np.int8,mode='r',shape=(self.nmarkers,self.nsamples))
+        self.matrix=np.memmap(os.path.join(self.dir,'samples.bin'),dtype=np.int8,mode='w+',shape=(self.nsamples,self.nmarkers))
+        for m in range(0,self.nmarkers,chunksize):
+            self.matrix[:,m:m+chunksize]=markers[m:m+chunksize].T
+        self.matrix.flush()
+        del markers
+        os.remove(os.path.join(self.dir,'markers.bin'))
+        return self.matrix
+
+    def marker_ids(self):
+        """Yields the appended marker IDs in order"""
+        with open(os.path.join(self.dir,'ids.txt'),'rb') as infile:
+            for line in infile:
+                yield line.rstrip(b'\n')
+
+    def close(self):
+        if not self.markers.closed:
+            self.markers.close()
+            self.ids.close()
+        self.matrix=None
+        shutil.rmtree(self.dir,ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+
+def chunked(iterable,size):
+    buf=[]
+    for i in iterable:
+        buf.append(i)
+        if len(buf) == size:
+            yield buf
+            buf=[]
+    if buf:
+        yield buf
+
+
+def write_geno_csv(outfile,samples,buffer,chunksize=10000):
+    """Writes the transposed buffer to the binary file object outfile as a qtl2 csv with an
+    ind column of sample names followed by one column per marker"""
+    matrix=buffer.transpose(chunksize)
+    outfile.write(b'ind')
+    for ids in chunked(buffer.marker_ids(),chunksize):
+        outfile.write(b','+b','.join(ids))
+    for s,sample in enumerate(samples):
+        outfile.write(b'\n'+sample.encode())
+        for m in range(0,buffer.nmarkers,chunksize):
+            outfile.write(b','+b','.join(LABELS[matrix[s,m:m+chunksize]]))
+    outfile.write(b'\n')
+
+
+def vcf_to_csv(vcf,outfile,chunksize=10000,tmpdir=None,cache=False):
+    """Converts vcf to a qtl2 csv with samples as rows, reading the genotype cache of vcf if it
+    is current (or built, if cache is True)
+    Returns: list of samples"""
+    gcache=find_cache(vcf,cache)
+    samples=vcf_samples(vcf) if gcache is None else list(gcache.samples)
+    tmpdir=tmpdir if tmpdir else os.path.dirname(os.path.abspath(outfile))
+    with TransposeBuffer(len(samples),tmpdir) as buffer:
+        for ids,pos,codes in genotype_chunks(vcf,len(samples),chunksize,cache=gcache):
+            buffer.append(ids,codes)
+        print("Read vcf file: Contains info on {0} samples and {1} markers".format(len(samples),buffer.nmarkers))
+        print("Writing out to {0}".format(outfile))
+        with open(outfile,'wb') as out:
+            write_geno_csv(out,samples,buffer,chunksize)
+    return samples
+
 
 def get_genofile():
     args=parse_args()
-    samples,info = call_bcftools(args.infile)
-    txt='ind'
-    geno={}
-    for s in range(1,len(samples)+1):
-        geno[s] = [samples[s-1]]
-    for i in info:
-        split=i.split('\t')
-        marker = split[0]
-        txt+=','+marker
-        count=1
-        if 2 in split[1:]:
-            for n in split[1:]:
-                if './.' in n:
-                    n='NA'
-                elif '1' in n:
-                    n='A'
-                else:
-                    n='B'
-                geno[count].append(n)
-                count+=1
-        else:
-            for n in split[1:]:
-                if './.' in n:
-                    n='NA'
-                elif '0' in n:
-                    n='A'
-                else:
-                    n='B'
-                geno[count].append(n)
-                count+=1
-    for j in geno.keys():
-        txt+='\n'+ ','.join(geno[j])
-    print "Writing out to {0}".format(args.outfile)
-    with open(args.outfile,'w') as outfile:
-        outfile.write(txt)
-
+    vcf_to_csv(args.infile,args.outfile,args.chunksize,args.tmpdir,args.cache)
 
 
 if __name__ == "__main__":
     get_genofile()
-
-
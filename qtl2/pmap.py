@@ -5,13 +5,19 @@ Generates a physical map file in csv format.
 This csv file is formatted for use with R/qtl2
 """
 
+import os
+import sys
 import argparse
-from subprocess import Popen,PIPE
+import pandas as pd
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','pscripts'))
+import bcftools_exec
+import geno_cache
 
 def parse_args():
     """ -h for info on arguments
     """
-    parser = argparse.ArgumentParser(description="""Program description: Generates a physical map file in csv format.                                                             
+    parser = argparse.ArgumentParser(description="""Program description: Generates a physical map file in csv format.
 This csv file is formatted for use with R/qtl2""")
     parser.add_argument("infile",type=str,help="""The input vcf file containing the markers and physical positions""")
     parser.add_argument("outfile",type=str,help="""The output csv filename""")
@@ -20,31 +26,34 @@ This csv file is formatted for use with R/qtl2""")
 
 
 def call_bcftools(vcf):
-    process=Popen(["bcftools","query","-f","%ID,%CHROM,%POS\n",vcf],stdout=PIPE,stderr=PIPE)
-    stdout,stderr=process.communicate()
-    print(stderr)
-    return stdout
+    """Yields the marker, chromosome and position (bp) lines of vcf as they are read.
+    Raises bcftools_exec.BcftoolsError if bcftools fails"""
+    return bcftools_exec.lines(["query","-f","%ID,%CHROM,%POS\n",vcf])
+
+
+def cache_sites(vcf):
+    """Returns: pandas df (chrom, pos, id, ref, alt) of the sites of vcf from its genotype cache
+    (geno_cache.py), or None if it has no current cache"""
+    path=geno_cache.cache_path(vcf)
+    if not geno_cache.is_current(vcf,path):
+        return None
+    return geno_cache.GenoCache(path).sites()
 
 
 def get_pmap():
     args=parse_args()
-    txt='marker,chr,pos\n'
-    stdout=call_bcftools(args.infile)
-    markers=stdout.split('\n')[:-1]
-    for line in markers:
-        info = line.split(',')
-        marker = info[0]
-        chrom=info[1]
-        pos=float(info[2])/1e6
-        tmp='{0},{1},{2}\n'.format(marker,chrom,pos)
-        txt+=tmp
-    print "Writing out to {0}".format(args.outfile)
+    sites=cache_sites(args.infile)
+    print("Writing out to {0}".format(args.outfile))
     with open(args.outfile,'w') as outfile:
-        outfile.write(txt)
+        outfile.write('marker,chr,pos\n')
+        if sites is not None:
+            pd.DataFrame({'marker':sites['id'],'chr':sites['chrom'],'pos':sites['pos']/1e6}).to_csv(outfile,header=False,index=False)
+            return
+        for line in call_bcftools(args.infile):
+            marker,chrom,pos=line.decode().split(',')
+            outfile.write('{0},{1},{2}\n'.format(marker,chrom,float(pos)/1e6))
 
 
 
 if __name__ == "__main__":
     get_pmap()
-
-
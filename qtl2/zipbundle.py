@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""
+Writes zip files with members compressed in parallel threads, for the qtl2 input bundles
+read by read_cross2(). Member data is cut into chunks that are deflated in a thread pool
+while the next chunk is being produced. Each chunk is primed with the last 32kb of the chunk
+before it and all but the last end with a sync flush, so the compressed chunks join into one
+deflate stream (as in pigz). Members and files over 4Gb are written as zip64.
+"""
+
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Deflate window, the data primed into the compressor of each chunk
+WINDOW=1 << 15
+# Sizes and offsets above this are stored in zip64 extra fields
+ZIP64_LIMIT=0xFFFFFFFF
+
+
+def deflate(data,level,zdict,last):
+    """Raw deflate of one chunk of a member, primed with zdict (the end of the chunk before)"""
+    if zdict:
+        compressor=zlib.compressobj(level,zlib.DEFLATED,-15,8,zlib.Z_DEFAULT_STRATEGY,zdict)
+    else:
+        compressor=zlib.compressobj(level,zlib.DEFLATED,-15)
+    return compressor.compress(data)+compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def field32(value):
+    """value for a 32 bit size or offset field, 0xFFFFFFFF if it is in a zip64 extra field"""
+    return 0xFFFFFFFF if value > ZIP64_LIMIT else value
+
+
+def dos_time(t):
+    """MS-DOS time and date of the unix time t"""
+    t=time.localtime(t)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),((t.tm_year-1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class ZipMember(object):
+    """Writable binary file object for one member of a ZipWriter, from ZipWriter.open()"""
+
+    def __init__(self,writer,name):
+        self.writer=writer
+        self.name=name.encode()
+        self.crc=0
+        self.size=0
+        self.csize=0
+        self.buf=[]
+        self.buflen=0
+        self.prev=b''
+        self.pending=deque()
+        self.closed=False
+        self.time,self.date=dos_time(time.time())
+        self.offset=writer.file.tell()
+        writer.file.write(self.local_header())
+
+    def local_header(self):
+        """Local file header. Sizes are always in a zip64 extra field so the header has the
+        same length when it is rewritten with the final sizes"""
+        extra=struct.pack('<HHQQ',1,16,self.size,self.csize)
+        return struct.pack('<IHHHHHIIIHH',0x04034b50,45,0,8,self.time,self.date,self.crc,
+                           0xFFFFFFFF,0xFFFFFFFF,len(self.name),len(extra))+self.name+extra
+
+    def write(self,data):
+        if self.closed:
+            raise ValueError("write to closed zip member {0}".format(self.name.decode()))
+        n=len(data)
+        self.buf.append(bytes(data))
+        self.buflen+=n
+        chunksize=self.writer.chunksize
+        if self.buflen >= chunksize:
+            data=b''.join(self.buf)
+            end=len(data)-len(data) % chunksize
+            for start in range(0,end,chunksize):
+                self.submit(data[start:start+chunksize],False)
+            self.buf=[data[end:]]
+            self.buflen=len(data)-end
+        return n
+
+    def submit(self,chunk,last):
+        """Queues chunk for compression, writing finished chunks in order once more than
+        two per thread are waiting"""
+        self.crc=zlib.crc32(chunk,self.crc)
+        self.size+=len(chunk)
+        self.pending.append(self.writer.pool.submit(deflate,chunk,self.writer.level,self.prev,last))
+        self.prev=chunk[-WINDOW:]
+        while len(self.pending) > 2*self.writer.threads:
+            self.write_compressed(self.pending.popleft().result())
+
+    def write_compressed(self,data):
+        self.writer.file.write(data)
+        self.csize+=len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.submit(b''.join(self.buf),True)
+        self.buf=[]
+        while self.pending:
+            self.write_compressed(self.pending.popleft().result())
+        end=self.writer.file.tell()
+        self.writer.file.seek(self.offset)
+        self.writer.file.write(self.local_header())
+        self.writer.file.seek(end)
+        self.closed=True
+        self.writer.member_closed(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+
+class ZipWriter(object):
+    """Writes a zip file one member at a time, compressing each member in threads
+    Input:
+    path: (str) output zip file
+    threads: (int) number of compression threads (Default: 4)
+    level: (int) deflate level 1..9 (Default: 6)
+    chunksize: (int) bytes of a member compressed per task (Default: 4Mb)
+    """
+
+    def __init__(self,path,threads=4,level=6,chunksize=1 << 22):
+        self.path=path
+        self.threads=max(int(threads),1)
+        self.level=level
+        self.chunksize=chunksize
+        self.file=open(path,'wb')
+        self.pool=ThreadPoolExecutor(self.threads)
+        self.entries=[]
+        self.current=None
+
+    def open(self,name):
+        """Returns: a writable binary file object for a new member name"""
+        if self.current is not None:
+            raise ValueError("Close zip member {0} before opening {1}".format(self.current.name.decode(),name))
+        self.current=ZipMember(self,name)
+        return self.current
+
+    def writestr(self,name,data):
+        """Writes bytes or str data as the member name"""
+        with self.open(name) as member:
+            member.write(data.encode() if isinstance(data,str) else data)
+
+    def member_closed(self,member):
+        self.entries.append((member.name,member.crc,member.size,member.csize,member.offset,member.time,member.date))
+        self.current=None
+
+    def central_directory(self):
+        records=[]
+        for name,crc,size,csize,offset,mtime,mdate in self.entries:
+            zip64=[v for v in (size,csize,offset) if v > ZIP64_LIMIT]
+            extra=struct.pack('<HH'+'Q'*len(zip64),1,8*len(zip64),*zip64) if zip64 else b''
+            records.append(struct.pack('<IHHHHHHIIIHHHHHII',0x02014b50,45,45,0,8,mtime,mdate,crc,
+                                       field32(csize),field32(size),len(name),len(extra),0,0,0,
+                                       0o644 << 16,field32(offset))+name+extra)
+        return b''.join(records)
+
+    def close(self):
+        if self.file.closed:
+            return
+        if self.current is not None:
+            self.current.close()
+        self.pool.shutdown()
+        start=self.file.tell()
+        directory=self.central_directory()
+        self.file.write(directory)
+        n=len(self.entries)
+        if n >= 0xFFFF or start > ZIP64_LIMIT or len(directory) > ZIP64_LIMIT:
+            end64=self.file.tell()
+            self.file.write(struct.pack('<IQHHIIQQQQ',0x06064b50,44,45,45,0,0,n,n,len(directory),start))
+            self.file.write(struct.pack('<IIQI',0x07064b50,0,end64,1))
+        self.file.write(struct.pack('<IHHHHIIH',0x06054b50,0,0,min(n,0xFFFF),min(n,0xFFFF),
+                                    field32(len(directory)),field32(start),0))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()